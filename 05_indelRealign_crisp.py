@@ -39,13 +39,19 @@ module load java
 export _JAVA_OPTIONS="-Xms256m -Xmx7g"
 java -Djava.io.tmpdir=$SLURM_TMPDIR -jar $EBROOTGATK/GenomeAnalysisTK.jar \
 -T IndelRealigner -R %(ref)s -I %(dupfile)s -targetIntervals %(listfile)s -o %(realbam)s
+realign_exit=$?
 module unload gatk
 
-# sbatch CRISP job if all pooled bamfiles have been created
+# record that this samp is done, sbatch CRISP job if all pooled bamfiles have been created
 source $HOME/.bashrc
 export PYTHONPATH="${PYTHONPATH}:$HOME/pipeline"
 export SQUEUE_FORMAT="%%.8i %%.8u %%.12a %%.68j %%.3t %%16S %%.10L %%.5D %%.4C %%.6b %%.7m %%N (%%r)"
-python $HOME/pipeline/start_crispANDvarscan.py %(parentdir)s %(pool)s
+if [ $realign_exit -eq 0 ]; then
+    # samtools idxstats counts the pool's reads to balance its bedfiles (see create_bedfiles.make_pool_bedfiles)
+    module load samtools/1.9
+    python $HOME/pipeline/start_crispANDvarscan.py %(parentdir)s %(pool)s %(samp)s
+    module unload samtools
+fi
 python $HOME/pipeline/balance_queue.py bedfile
 
 ''' % locals()
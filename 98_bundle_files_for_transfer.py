@@ -137,6 +137,8 @@ for p in pooldirs:
     # double check for _all_SNPs and _all_INDELs
     md5files = [f for f in fs(varscan) if f.endswith('.md5') and '_all_' in f]
     srcfiles = [f for f in fs(varscan) if f.endswith('.txt') and '_all_' in f]
+    # indexes for bgzipped _all_ files (the .gz files were added above)
+    cmds.extend(get_cmds([f for f in fs(varscan) if f.endswith('.gz.idx')], md5files, remotevarscan, False))
     if not len(srcfiles) == 2:
         warning = f"\nWARN: There are not two all-files (SNP + INDEL) which are expected output for pool: {op.basename(p)}"
         warning = warning + "\nWARN: Here are the files I found:\n"
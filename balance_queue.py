@@ -44,7 +44,8 @@ def checksq(sq):
         if 'socket' in s.lower():
             print("socket in sq return, exiting %(thisfile)s" % globals())
             exitneeded = True
-        if not int(s.split()[0]) == float(s.split()[0]):
+        # job array ids are arrayid_task or arrayid_[tasks]
+        if not int(s.split()[0].split('_')[0]) == float(s.split()[0].split('_')[0]):
             print("could not assert int == float, %s" % (s[0]))
             exitneeded = True
     if exitneeded is True:
@@ -0,0 +1,322 @@
+"""Benchmark the filtering stages of filter_VariantsToTable on synthetic data.
+
+### purpose
+# create synthetic VariantsToTable output (varscan or crisp layout) and time each stage of
+# filter_VariantsToTable.main() so that regressions and speedups are visible before deployment
+###
+
+### usage
+# python benchmark_filter_VariantsToTable.py [-n LOCI [LOCI ...]] [-p POOLS] [--program {varscan,crisp,both}]
+#                                            [--missing RATE] [--multiallelic RATE] [--refn RATE]
+#                                            [--reps REPS] [--save JSON] [--baseline JSON] [--dir DIR]
+###
+
+### assumes
+# run locally (no slurm needed), from the pipeline dir or with pipeline on PYTHONPATH
+###
+"""
+
+import os, sys, io, gc, glob, json, time, shutil, tempfile, argparse, tracemalloc, pandas as pd, numpy as np
+from os import path as op
+from contextlib import redirect_stdout
+from coadaptree import pkldump, makedir, get_nrows
+import filter_VariantsToTable as fvtt
+
+
+BASES = np.array(['A', 'C', 'G', 'T'])
+VARSCAN_INFO = ['ADP', 'WT', 'HET', 'HOM', 'NC']
+CRISP_INFO = ['DP', 'CT', 'AC', 'VT', 'EMstats', 'HWEstats', 'VF', 'VP', 'HP', 'MQS']
+
+
+def make_pooldir(parentdir, pool, program, npools, ploidy=2):
+    """Create parentdir/pool/program and the .pkl files that filter_VariantsToTable needs to find ploidy etc."""
+    pkldump({pool: ['%s_samp%s' % (pool, i) for i in range(npools)]}, op.join(parentdir, 'poolsamps.pkl'))
+    pkldump({pool: ploidy}, op.join(parentdir, 'ploidy.pkl'))
+    return makedir(op.join(parentdir, pool, program))
+
+
+def get_loci(rng, nloci, multiallelic, refn, indel=0.1):
+    """
+    Create one row per ALT allele (like gatk VariantsToTable --split-multi-allelic).
+
+    Returns:
+    df - pandas.dataframe with CHROM, POS, REF, ALT, TYPE
+    """
+    # ~100 loci per contig, positions sorted within contig
+    contigs = np.cumsum(rng.rand(nloci) < 0.01)
+    pos = np.cumsum(rng.randint(1, 50, nloci))
+    kind = rng.rand(nloci)
+    isrefn = kind < refn
+    ismulti = (kind >= refn) & (kind < refn + multiallelic)
+    nalts = np.where(isrefn | ismulti, 2, 1)
+
+    # two different ALT alleles that also differ from REF
+    refidx = rng.randint(0, 4, nloci)
+    step = rng.randint(1, 3, nloci)
+    alt1 = BASES[(refidx + step) % 4]
+    alt2 = BASES[(refidx + step + 1) % 4]
+    ref = np.where(isrefn, 'N', BASES[refidx])
+    tipe = np.where((nalts == 1) & (rng.rand(nloci) < indel), 'INDEL', 'SNP')
+    alt1 = np.where(tipe == 'INDEL', np.char.add(ref, 'T'), alt1)
+
+    rows = np.repeat(np.arange(nloci), nalts)
+    second = np.zeros(len(rows), dtype=bool)
+    second[1:] = rows[1:] == rows[:-1]
+    return pd.DataFrame({'CHROM': np.char.add('scaffold_', contigs[rows].astype(str)),
+                         'POS': pos[rows],
+                         'REF': ref[rows],
+                         'ALT': np.where(second, alt2[rows], alt1[rows]),
+                         'TYPE': tipe[rows]})
+
+
+def get_varscan_fields(rng, loci, prefix):
+    """Create varscan genotype fields for one pool."""
+    n = len(loci.index)
+    ref, alt = loci['REF'].values.astype(str), loci['ALT'].values.astype(str)
+    gts = np.array([np.char.add(np.char.add(ref, '/'), alt),
+                    np.char.add(np.char.add(alt, '/'), alt),
+                    np.char.add(np.char.add(ref, '/'), ref)])
+    gt = gts[rng.randint(0, 3, n), np.arange(n)]
+    gt = np.where((ref == 'N') & (rng.rand(n) < 0.2), 'N/N', gt)
+    freqs = np.round(rng.rand(n) * 100, 2)
+    return {f'{prefix}.GT': gt,
+            f'{prefix}.GQ': rng.randint(5, 100, n),
+            f'{prefix}.SDP': rng.randint(8, 200, n),
+            f'{prefix}.DP': rng.randint(8, 200, n),
+            f'{prefix}.FREQ': np.char.mod('%g%%', freqs),
+            f'{prefix}.PVAL': np.round(rng.rand(n), 4),
+            f'{prefix}.AD': rng.randint(0, 100, n)}
+
+
+def get_crisp_fields(rng, loci, prefix, ploidy=4):
+    """Create crisp genotype fields for one pool."""
+    n = len(loci.index)
+    alleles = np.array([loci['REF'].values.astype(str), loci['ALT'].values.astype(str)])
+    gt = alleles[rng.randint(0, 2, n), np.arange(n)]
+    for i in range(ploidy - 1):
+        gt = np.char.add(np.char.add(gt, '/'), alleles[rng.randint(0, 2, n), np.arange(n)])
+    return {f'{prefix}.GT': gt,
+            f'{prefix}.GQ': rng.randint(5, 100, n),
+            f'{prefix}.DP': rng.randint(8, 200, n)}
+
+
+def make_table(tablefile, program, nloci, npools, missing=0.1, multiallelic=0.05, refn=0.02, seed=0):
+    """
+    Write synthetic gatk VariantsToTable output for varscan or crisp vcf files.
+
+    Positional arguments:
+    tablefile - path to write
+    program - str; either "varscan" or "crisp" - determines column layout
+    nloci - int; number of loci (multiallelic and REF=N loci have two rows)
+    npools - int; number of pools
+
+    Keyword arguments:
+    missing - float; rate of missing genotypes per pool
+    multiallelic - float; rate of loci with two ALT alleles
+    refn - float; rate of loci with REF=N and two ALT alleles (varscan only)
+    seed - int; seed for numpy.random.RandomState
+    """
+    rng = np.random.RandomState(seed)
+    # as far as I can tell, crisp output from convert_pooled_vcf.py will not output REF = N
+    loci = get_loci(rng, nloci, multiallelic, refn if program == 'varscan' else 0)
+    n = len(loci.index)
+    data = loci[['CHROM', 'POS', 'REF', 'ALT']].copy()
+    data['AF'] = np.round(rng.rand(n), 3)
+    data['QUAL'] = '.'
+    data['TYPE'] = loci['TYPE']
+    data['FILTER'] = 'PASS'
+    if program == 'varscan':
+        bednum = None
+        for col in VARSCAN_INFO:
+            data[col] = rng.randint(0, 100, n)
+    else:
+        bednum = op.basename(tablefile).split("file_")[-1].split("_converted")[0]
+        for col in CRISP_INFO:
+            data[col] = rng.randint(0, 100, n)
+    for i in range(npools):
+        if program == 'varscan':
+            fields = get_varscan_fields(rng, loci, f'Sample{i+1}')
+        else:
+            fields = get_crisp_fields(rng, loci, f'samp{i}_realigned_{bednum}')
+        ismissing = rng.rand(n) < missing
+        for col, vals in fields.items():
+            vals = pd.Series(vals)
+            if col.endswith('.GT') and program == 'crisp':
+                data[col] = vals.where(~ismissing, './.')
+            else:
+                data[col] = vals.where(~ismissing)
+    data.to_csv(tablefile, sep='\t', index=False, na_rep='NA')
+    return tablefile
+
+
+def clear_caches(tablefile):
+    """Remove the .pkl sidecar caches of tablefile (see filter_VariantsToTable.get_cachefile)."""
+    for f in glob.glob(tablefile.replace('.txt', '') + '*.pkl'):
+        os.remove(f)
+
+
+def run_stage(func, args, reps, setup=None):
+    """
+    Time func(*args) over reps, then run once more under tracemalloc for peak memory.
+    Any pandas.dataframe args are copied before each run since some stages modify their input.
+
+    Keyword arguments:
+    setup - function called (untimed) before each run, eg to clear caches for cold runs
+
+    Returns:
+    out - return of the last call to func
+    stats - dict with best wall time (s), peak memory (MB), rows in and rows out
+    """
+    def getargs():
+        return [arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in args]
+
+    def call(callargs):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            out = func(*callargs)
+        return out, time.perf_counter() - start
+
+    times = []
+    for rep in range(reps):
+        out, elapsed = call(getargs())
+        times.append(elapsed)
+    # copy args before tracing so the copies are not counted as peak memory of the stage
+    callargs = getargs()
+    tracemalloc.start()
+    call(callargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, {'seconds': min(times),
+                 'peak_mb': peak / 1e6,
+                 'rows_in': get_nrows(args[0]),
+                 'rows_out': get_nrows(out)}
+
+
+def bench_table(tablefile, program, reps):
+    """
+    Run each stage of filter_VariantsToTable.main() on tablefile in the order main() runs them.
+
+    Returns:
+    stages - list of (stage_name, stats) tuples
+    """
+    tf = op.basename(tablefile)
+    tipe = 'SNP'
+    stages = []
+
+    def stage(name, func, *args, setup=None):
+        out, stats = run_stage(func, args, reps, setup)
+        stages.append((name, stats))
+        return out
+
+    def cold():
+        clear_caches(tablefile)
+
+    df, tf = stage('load_data', fvtt.load_data, tablefile, False)
+    # cold runs start without caches (and create them), warm runs only load them
+    stage('load_data_cold', fvtt.load_data, tablefile, True, setup=cold)
+    stage('load_data_warm', fvtt.load_data, tablefile, True)
+    ndfs = stage('get_refn_snps', fvtt.get_refn_snps, df, tipe)
+    rowmask = stage('keep_snps', fvtt.keep_snps, df, tf)
+    rowmask = rowmask & stage('filter_type', fvtt.filter_type, df, tipe)
+    rows = np.flatnonzero(rowmask)
+    if program == 'varscan':
+        qualcols = [col for col in df.columns if '.GQ' in col or '.FREQ' in col]
+        data = stage('get_columns', fvtt.get_columns, df, ndfs, rows, qualcols)
+        freqs, badqual = stage('mask_qual', fvtt.mask_qual, data)
+        keep = stage('filter_missing_data', fvtt.filter_missing_data, freqs)
+        keep, globfreqs = stage('filter_freq', fvtt.filter_freq, freqs, tf, tipe, tablefile, keep)
+        stage('take_rows', fvtt.take_rows, df, ndfs, rows, keep)
+    else:
+        gtcols = [col for col in df.columns if '.GT' in col]
+        data = stage('get_columns', fvtt.get_columns, df, ndfs, rows, ['REF', 'ALT', 'AF'] + gtcols)
+        freqs = stage('get_pool_freqs', fvtt.get_pool_freqs, data)
+        afs = stage('recalc_global_freq', fvtt.recalc_global_freq, freqs, data['AF'].values)
+        keep = stage('filter_missing_data', fvtt.filter_missing_data, freqs)
+        keep = stage('filter_freq', fvtt.filter_af, afs, tablefile, keep)
+        snps = stage('take_rows', fvtt.take_rows, df, ndfs, rows, keep)
+        stage('add_freq_cols', fvtt.add_freq_cols, snps, tf, freqs[:, keep], afs[keep])
+    stage('main_cold', fvtt.main, tablefile, tipe, True, setup=cold)
+    stage('main_warm', fvtt.main, tablefile, tipe, True)
+    clear_caches(tablefile)
+    return stages
+
+
+def print_results(results, baseline):
+    """Print a table of results, with speedups relative to baseline results if given."""
+    header = f"{'program':<8} {'loci':>8} {'stage':<20} {'seconds':>9} {'peak_MB':>9} {'rows_in':>9} {'rows_out':>9}"
+    if baseline:
+        header += f" {'base_s':>9} {'speedup':>8}"
+    print(header)
+    print('-' * len(header))
+    for key, stats in results.items():
+        program, nloci, name = key.split('|')
+        line = (f"{program:<8} {nloci:>8} {name:<20} {stats['seconds']:>9.4f} {stats['peak_mb']:>9.1f} "
+                f"{str(stats['rows_in']):>9} {str(stats['rows_out']):>9}")
+        if baseline:
+            if key in baseline:
+                base = baseline[key]['seconds']
+                line += f" {base:>9.4f} {base / stats['seconds']:>7.2f}x"
+            else:
+                line += f" {'-':>9} {'-':>8}"
+        print(line)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--loci', type=int, nargs='+', default=[10000, 50000],
+                        help='number(s) of loci in each synthetic table (default: 10000 50000)')
+    parser.add_argument('-p', '--pools', type=int, default=20,
+                        help='number of pools (default: 20)')
+    parser.add_argument('--program', choices=['varscan', 'crisp', 'both'], default='both',
+                        help='VariantsToTable column layout to benchmark (default: both)')
+    parser.add_argument('--missing', type=float, default=0.1,
+                        help='rate of missing genotypes per pool (default: 0.1)')
+    parser.add_argument('--multiallelic', type=float, default=0.05,
+                        help='rate of multiallelic loci (default: 0.05)')
+    parser.add_argument('--refn', type=float, default=0.02,
+                        help='rate of REF=N loci with two ALT alleles, varscan only (default: 0.02)')
+    parser.add_argument('--reps', type=int, default=3,
+                        help='number of timed runs per stage, best is reported (default: 3)')
+    parser.add_argument('--save', help='write results to this json file (eg to use as a baseline later)')
+    parser.add_argument('--baseline', help='json file from a previous --save to compare against')
+    parser.add_argument('--dir', help='directory for synthetic data (default: temporary dir, removed after)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    programs = ['varscan', 'crisp'] if args.program == 'both' else [args.program]
+    parentdir = makedir(args.dir) if args.dir else tempfile.mkdtemp(prefix='bench_vtt_')
+    baseline = json.load(open(args.baseline)) if args.baseline else None
+
+    results = {}
+    try:
+        for program in programs:
+            pooldir = make_pooldir(parentdir, 'pool', program, args.pools)
+            for nloci in args.loci:
+                if program == 'varscan':
+                    tablefile = op.join(pooldir, f'pool_varscan_bedfile_{nloci}_table.txt')
+                else:
+                    tablefile = op.join(pooldir, f'pool_crisp_bedfile_{nloci}_converted_table.txt')
+                print(f'creating {op.basename(tablefile)} ({nloci} loci, {args.pools} pools)', file=sys.stderr)
+                make_table(tablefile, program, nloci, args.pools,
+                           missing=args.missing, multiallelic=args.multiallelic, refn=args.refn)
+                print(f'benchmarking {op.basename(tablefile)}', file=sys.stderr)
+                for name, stats in bench_table(tablefile, program, args.reps):
+                    results[f'{program}|{nloci}|{name}'] = stats
+    finally:
+        if not args.dir:
+            shutil.rmtree(parentdir)
+
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as o:
+            json.dump(results, o, indent=1)
+        print(f'saved results to {args.save}')
+
+
+if __name__ == '__main__':
+    main()
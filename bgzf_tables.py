@@ -0,0 +1,262 @@
+"""Write and query bgzip-compressed, position-indexed variant tables.
+
+### purpose
+# write combined VariantsToTable output as a block-compressed (BGZF) file sorted by CHROM and POS,
+# with an index of the first row of each WINDOW bp of each contig so that a region can be read
+# by seeking to a few blocks instead of reading the entire file
+# the .gz file is standard BGZF (zcat, gzip -d, bgzip -d, tabix -s 2 -b 3 -e 3 -S 1 all work)
+###
+
+### usage
+# python bgzf_tables.py {pool}-varscan_all_bedfiles_SNP.txt.gz CHROM[:start-end] [CHROM[:start-end] ...]
+# (prints the header and the rows within each region, start and end are 1-based and inclusive)
+# OR
+# from bgzf_tables import query
+# df = query('/path/to/{pool}-varscan_all_bedfiles_SNP.txt.gz', 'scaffold_1:1000-5000')
+###
+"""
+
+import io, sys, zlib, struct, bisect, pandas as pd
+from os import path as op
+from coadaptree import pklload, pkldump
+
+
+# max uncompressed bytes per BGZF block (same as bgzip)
+BLOCK_SIZE = 0xff00
+
+# bp per index window (same as the tabix linear index)
+WINDOW = 16384
+
+# empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def get_indexfile(gzfile):
+    """Get the path to the index of a bgzipped table."""
+    return gzfile + '.idx'
+
+
+class BgzfWriter:
+    """
+    Write text to a BGZF file - gzip members (blocks) of at most BLOCK_SIZE uncompressed bytes.
+
+    Positional arguments:
+    filename - path to .gz file to (over)write
+    """
+    def __init__(self, filename):
+        self.handle = open(filename, 'wb')
+        self.buffer = bytearray()
+        self.blockstart = 0  # compressed offset of the block being filled
+
+    def tell(self):
+        """Virtual offset of the next byte written - compressed block offset << 16 | offset in block."""
+        return (self.blockstart << 16) | len(self.buffer)
+
+    def write(self, text):
+        self.buffer += text.encode()
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.flush_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flush_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        # gzip header with the BC extra subfield that holds the total block size - 1
+        header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                             len(cdata) + 25)
+        block = header + cdata + struct.pack('<2I', zlib.crc32(data), len(data))
+        self.handle.write(block)
+        self.blockstart += len(block)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.flush_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+
+class BgzfReader:
+    """
+    Read lines from a BGZF file starting at a virtual offset (see BgzfWriter.tell()).
+
+    Positional arguments:
+    filename - path to .gz file
+    """
+    def __init__(self, filename):
+        self.handle = open(filename, 'rb')
+        self.data = b''
+        self.pos = 0
+
+    def read_block(self):
+        """Decompress the next block into self.data, return False at end of file."""
+        header = self.handle.read(18)
+        if len(header) < 18:
+            return False
+        bsize = struct.unpack('<H', header[16:18])[0]
+        cdata = self.handle.read(bsize - 25)
+        self.handle.read(8)  # crc32 and uncompressed size
+        self.data = zlib.decompress(cdata, -15)
+        self.pos = 0
+        return True
+
+    def seek(self, voffset):
+        self.handle.seek(voffset >> 16)
+        self.read_block()
+        self.pos = voffset & 0xffff
+
+    def readline(self):
+        """Read the next line (including lines that span blocks), '' at end of file."""
+        line = b''
+        while True:
+            end = self.data.find(b'\n', self.pos)
+            if end != -1:
+                line += self.data[self.pos:end + 1]
+                self.pos = end + 1
+                return line.decode()
+            line += self.data[self.pos:]
+            if self.read_block() is False:
+                return line.decode()
+
+    def close(self):
+        self.handle.close()
+
+
+class IndexedTableWriter:
+    """
+    Write rows to a bgzipped, position-indexed table.
+    Rows must be written sorted by CHROM and POS (eg from combine_crispORvarscan.merge_pieces()).
+
+    Positional arguments:
+    gzfile - path to .gz file to (over)write, the index is written to gzfile + '.idx'
+    columns - list of column names, written as the header
+    """
+    def __init__(self, gzfile, columns):
+        self.gzfile = gzfile
+        self.columns = list(columns)
+        self.writer = BgzfWriter(gzfile)
+        self.writer.write('\t'.join(self.columns) + '\n')
+        # contigs = {chrom: ([window, ...], [virtual offset of first row in window, ...])}
+        self.contigs = {}
+        self.lastchrom = None
+        self.lastpos = -1
+        self.lastwindow = None
+
+    def write_line(self, line, chrom, pos):
+        """Append a row (with newline) at chrom:pos, index it if it is the first row in its window."""
+        window = pos // WINDOW
+        if chrom != self.lastchrom:
+            if chrom in self.contigs:
+                raise ValueError(f'{chrom} continues after {self.lastchrom} started in {self.gzfile}')
+            self.contigs[chrom] = ([], [])
+            self.lastchrom, self.lastwindow = chrom, None
+        elif pos < self.lastpos:
+            raise ValueError(f'{chrom}:{pos} comes after {chrom}:{self.lastpos} in {self.gzfile}')
+        if window != self.lastwindow:
+            keys, offsets = self.contigs[chrom]
+            keys.append(window)
+            offsets.append(self.writer.tell())
+            self.lastwindow = window
+        self.lastpos = pos
+        self.writer.write(line)
+
+    def close(self):
+        """Finish the .gz file and write its index."""
+        self.writer.close()
+        pkldump({'columns': self.columns,
+                 'window': WINDOW,
+                 'contigs': self.contigs}, get_indexfile(self.gzfile))
+        print(f'wrote indexed table to {self.gzfile}')
+
+
+def parse_region(region):
+    """
+    Split region into chrom, start, end.
+
+    Positional arguments:
+    region - str; CHROM, CHROM:start, or CHROM:start-end (1-based, inclusive)
+
+    Returns:
+    chrom, start, end - start is 1 and end is None (end of contig) if not in region
+    """
+    if ':' in region:
+        chrom, interval = region.rsplit(':', 1)
+        start, _, end = interval.replace(',', '').partition('-')
+        if start.isdigit() and (end == '' or end.isdigit()):
+            return chrom, int(start), int(end) if end != '' else None
+    return region, 1, None
+
+
+def fetch(gzfile, chrom, start=1, end=None, index=None):
+    """
+    Read the rows of a bgzipped table within a region.
+    Only the blocks from the first row of start's window to end are read.
+
+    Positional arguments:
+    gzfile - path to .gz file from IndexedTableWriter
+    chrom - str; contig name
+
+    Keyword arguments:
+    start - int; first position (1-based, inclusive)
+    end - int; last position (inclusive), default end of contig
+    index - dict; loaded index (from get_indexfile(gzfile)), loaded if None
+
+    Yields:
+    line - str; row of the table (with newline)
+    """
+    if index is None:
+        index = pklload(get_indexfile(gzfile))
+    if chrom not in index['contigs']:
+        return
+    keys, offsets = index['contigs'][chrom]
+    i = bisect.bisect_right(keys, start // index['window']) - 1
+    chromcol, poscol = index['columns'].index('CHROM'), index['columns'].index('POS')
+    reader = BgzfReader(gzfile)
+    reader.seek(offsets[max(i, 0)])
+    try:
+        while True:
+            line = reader.readline()
+            if line == '':
+                break
+            fields = line.split('\t', max(chromcol, poscol) + 1)
+            if fields[chromcol] != chrom or (end is not None and int(fields[poscol]) > end):
+                break
+            if int(fields[poscol]) >= start:
+                yield line
+    finally:
+        reader.close()
+
+
+def query(gzfile, region):
+    """
+    Get the rows of a bgzipped table within region.
+
+    Positional arguments:
+    gzfile - path to .gz file from IndexedTableWriter
+    region - str; CHROM, CHROM:start, or CHROM:start-end (1-based, inclusive)
+
+    Returns:
+    df - pandas.dataframe; rows within region
+    """
+    index = pklload(get_indexfile(gzfile))
+    chrom, start, end = parse_region(region)
+    text = '\t'.join(index['columns']) + '\n' + ''.join(fetch(gzfile, chrom, start, end, index=index))
+    return pd.read_csv(io.StringIO(text), sep='\t')
+
+
+def main(gzfile, regions):
+    if not op.exists(get_indexfile(gzfile)):
+        print(f'could not find index for {gzfile}. exiting.')
+        exit()
+    index = pklload(get_indexfile(gzfile))
+    sys.stdout.write('\t'.join(index['columns']) + '\n')
+    for region in regions:
+        chrom, start, end = parse_region(region)
+        for line in fetch(gzfile, chrom, start, end, index=index):
+            sys.stdout.write(line)
+
+
+if __name__ == '__main__':
+    thisfile, gzfile, *regions = sys.argv
+
+    main(gzfile, regions)
@@ -6,7 +6,10 @@
 """
 
 import os
+import json
+import time
 import pickle
+import resource
 from os import path as op
 
 
@@ -24,6 +27,84 @@ def pklload(path):
     return pkl
 
 
+def fingerprint(f):
+    """Get (size, mtime) of a file, used to tell if a file changed since it was cached."""
+    stat = os.stat(f)
+    return (stat.st_size, stat.st_mtime)
+
+
+def get_nrows(obj):
+    """
+    Count rows (loci) of obj, None if obj has no rows.
+    - dataframe: number of rows (for a list of dataframes, the total)
+    - boolean mask: number of True (loci kept)
+    - 2-D array: number of columns (matrices are one row per pool, one column per locus)
+    - tuple: rows of the first dataframe/array in the tuple
+    """
+    if isinstance(obj, list) and all(hasattr(o, 'shape') for o in obj):
+        return sum(get_nrows(o) for o in obj)
+    if isinstance(obj, tuple):
+        obj = next((o for o in obj if hasattr(o, 'shape')), None)
+    if hasattr(obj, 'index') and hasattr(obj, 'columns'):
+        return len(obj.index)
+    shape = getattr(obj, 'shape', ())
+    if len(shape) == 1 and obj.dtype == bool:
+        return int(obj.sum())
+    return int(shape[-1]) if len(shape) > 0 else None
+
+
+class Profiler:
+    """
+    Opt-in per-stage profiling - records wall time, cpu time, peak RSS, and rows in/out of each stage.
+    Switched on by setting the POOLSEQ_PROFILE environment variable (eg `export POOLSEQ_PROFILE=1`).
+    When off, Profiler.run() just calls the function and nothing is written.
+
+    Keyword arguments:
+    enabled - bool; override POOLSEQ_PROFILE
+    """
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get('POOLSEQ_PROFILE', '0') not in ['', '0', 'False', 'false']
+        self.enabled = enabled
+        self.context = {}  # added to every record (eg chunk number)
+        self.records = []
+
+    def reset(self):
+        self.context = {}
+        self.records = []
+
+    def run(self, stage, func, *args, **kwargs):
+        """Call func(*args, **kwargs) and record stats for stage, return output of func."""
+        if self.enabled is False:
+            return func(*args, **kwargs)
+        wall, cpu = time.perf_counter(), time.process_time()
+        out = func(*args, **kwargs)
+        record = {'stage': stage,
+                  'wall_s': round(time.perf_counter() - wall, 6),
+                  'cpu_s': round(time.process_time() - cpu, 6),
+                  # ru_maxrss is in KB on linux, peak is over the life of the process
+                  'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                  'rows_in': get_nrows(args[0]) if len(args) > 0 else None,
+                  'rows_out': get_nrows(out)}
+        record.update(self.context)
+        self.records.append(record)
+        return out
+
+    def annotate(self, **info):
+        """Add info to the most recent record."""
+        if self.enabled is True and len(self.records) > 0:
+            self.records[-1].update(info)
+
+    def dump(self, filename, **info):
+        """Write records (and any info) to filename as json."""
+        if self.enabled is False:
+            return
+        info['stages'] = self.records
+        with open(filename, 'w') as o:
+            json.dump(info, o, indent=1)
+        print(f'wrote profile to {filename}')
+
+
 def get_email_info(parentdir, stage):
     pkl = op.join(parentdir, 'email_opts.pkl')
     if op.exists(pkl):
@@ -5,7 +5,14 @@
 ###
 
 ### usage
-# python combine_crispORvarscan.py pooldir crispORvarscan poolORsamp
+# python combine_crispORvarscan.py pooldir crispORvarscan poolORsamp [workers [group ngroups]]
+# (workers - number of processes filtering tablefiles, default $SLURM_CPUS_PER_TASK or 1)
+# (group ngroups - tree-reduction: with group = 0 ... ngroups-1 only the bedfiles in that group are checked
+#     and combined into sorted group files, with group = final the ngroups group files are merged)
+# (export POOLSEQ_PROFILE=1 to write per-tablefile stats next to the all_bedfiles outputs)
+# (output is sorted by reference contig order (ref.fa.fai or ref.fa.length) and POS)
+# (also writes a bgzipped copy of each output with an index, query with bgzf_tables.py)
+# (filtered tablefiles are cached as *_{tipe}_filtered.pkl, a re-combine only re-filters changed tablefiles)
 ###
 
 ### assumes
@@ -13,11 +20,14 @@
 ###
 """
 
-import sys, pandas as pd
+import os, sys, heapq, shutil, pandas as pd, numpy as np
+from collections import deque
+from multiprocessing import Pool
 from os import path as op
-from coadaptree import fs, pklload
-from filter_VariantsToTable import main as filtvtt
-from start_crispANDvarscan import getfiles
+from coadaptree import fs, pklload, pkldump, makedir, Profiler
+from bgzf_tables import IndexedTableWriter
+from filter_VariantsToTable import filter_types, profiler as filtprofiler
+from start_crispANDvarscan import index_shdir, getfiles, getarrayfiles, get_bedfiles, get_groups, get_pid, check_sacct
 
 
 def get_varscan_names(df, pooldir):
@@ -42,48 +52,352 @@ def get_varscan_names(df, pooldir):
     return df
 
 
-def checkjobs():
+def checkjobs(group=None, ngroups=None):
     """
-    Make sure previous realigned bamfiles were created without error.
+    Make sure previous bedfile jobs were sbatched and finished without error.
     Avoids unintentionally combining a subset of all final expected files.
 
+    Keyword arguments:
+    group - int; only check the jobs of the bedfiles in this group (see get_groups())
+    ngroups - int; number of groups the bedfiles were split into
+
     Calls:
-    getfiles from start_crispANDvarscan
+    getfiles or getarrayfiles, and check_sacct from start_crispANDvarscan
     """
     print('checking jobs')
     parentdir = op.dirname(pooldir)
     pool = op.basename(pooldir)
-    ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
-    samps = fs(op.join(op.dirname(ref),
-                       'bedfiles_%s' % op.basename(ref).split(".fa")[0]))
     shdir = op.join(pooldir, 'shfiles/crispANDvarscan')
-    # files = {f.sh: f.out, ...}
-    files = getfiles(samps, shdir, f"{grep}-{program}")
+    # one pass over shdir, the checks below are dictionary lookups
+    index = index_shdir(shdir)
+    # bedfile jobs ran program alone or crisp and varscan together (see start_crispANDvarscan.make_sh())
+    shared = [sh for sh in index[0] if op.basename(sh).startswith(f"{grep}-crispANDvarscan_bedfile")]
+    caller = 'crispANDvarscan' if len(shared) > 0 else program
+    # bedfiles were run as tasks of one job array (see start_crispANDvarscan.create_array())
+    array = op.join(shdir, f"{grep}-{caller}_bedfile_array.sh") in index[0]
+    pids = None
+    if group is None and array is False:
+        samps = get_bedfiles(parentdir, pool)
+        # files = {f.sh: f.out, ...}
+        files = getfiles(samps, shdir, f"{grep}-{caller}", index)
+    else:
+        bedfiles = get_bedfiles(parentdir, pool)
+        if group is not None:
+            bedfiles = get_groups(bedfiles, ngroups)[group]
+        nums = [bedfile.split("_")[-1].split(".bed")[0] for bedfile in bedfiles]
+        if array is True:
+            files = getarrayfiles(nums, shdir, f"{grep}-{caller}_bedfile", index)
+            # sacct knows array tasks as arrayid_task
+            pids = [f'{get_pid(files[name])}_{int(name.split("_")[-1])}' for name in files]
+        else:
+            # jobs of other groups may still be pending, check this group's bedfiles one at a time
+            files = {}
+            for num in nums:
+                files.update(getfiles([num], shdir, f"{grep}-{caller}_bedfile_{num}", index))
+    # make sure the jobs didn't die
+    check_sacct(files.values(), pids)
     return files
 
 
-def get_types(tablefiles, tipe, program, pooldir, grep):
+def get_workers(workers=None):
+    """Get number of worker processes, default to the cpus slurm gave the job."""
+    if workers is None:
+        workers = os.environ.get('SLURM_CPUS_PER_TASK', 1)
+    return max(1, int(workers))
+
+
+def filter_tablefile(args):
+    """
+    Filter one tablefile for each tipe (run by worker processes in get_types()).
+
+    Positional arguments:
+    args - tuple of (tablefile, tipes)
+
+    Returns:
+    dfs - dict with key = tipe, val = pandas.dataframe; filtered VariantsToTable output
+    records - list of opt-in profile records for this tablefile
+    """
+    tablefile, tipes = args
+    prof = Profiler()
+    dfs = prof.run('filter_tablefile', filter_types, tablefile, tipes)
+    prof.annotate(tablefile=op.basename(tablefile),
+                  rows_out=dict((tipe, len(df.index)) for tipe, df in dfs.items()),
+                  stages=filtprofiler.records)
+    # pool workers exit without flushing, print() to a slurm .out file would be lost
+    sys.stdout.flush()
+    return dfs, prof.records
+
+
+def get_contig_order(pooldir):
+    """
+    Get the order of contigs in the reference (from ref.fa.fai or ref.fa.length).
+
+    Positional arguments:
+    pooldir - path to pool directory
+
+    Returns:
+    ranks - dict with key = contig, val = index of contig in reference (empty if there is no .fai/.length)
+    """
+    pool = op.basename(pooldir)
+    ref = pklload(op.join(op.dirname(pooldir), 'poolref.pkl'))[pool]
+    for lenfile in [ref + '.fai', ref + '.length']:
+        if op.exists(lenfile):
+            with open(lenfile, 'r') as o:
+                contigs = [line.split('\t')[0] for line in o.read().split('\n') if line != '']
+            return dict((contig, i) for i, contig in enumerate(contigs))
+    print(f'could not find .fai or .length file for {ref}, contigs will be in order of tablefiles')
+    return {}
+
+
+def write_piece(df, piecefile, ranks):
+    """
+    Sort a filtered tablefile by reference contig order and POS, and write it (without header) for merge_pieces().
+
+    Positional arguments:
+    df - pandas.dataframe; filtered VariantsToTable output
+    piecefile - path to write sorted df to
+    ranks - dict from get_contig_order(), contigs not in the reference are added in order of appearance
+    """
+    chroms = df['CHROM'].astype(str)
+    for chrom in pd.unique(chroms):
+        ranks.setdefault(chrom, len(ranks))
+    # lexsort is stable, rows of the same locus (eg INDELs) keep their order
+    order = np.lexsort((df['POS'].values, chroms.map(ranks).values))
+    df.iloc[order].to_csv(piecefile, sep='\t', index=False, header=False)
+
+
+def read_piece(num, piecefile, chromcol, poscol, ranks):
+    """
+    Read a sorted piece from write_piece() or merge_pieces(index=False) one row at a time.
+
+    Yields:
+    (rank of contig, POS, num, row number, CHROM, line) - sorts rows by contig order and POS, then piece and row
+    """
+    with open(piecefile, 'r') as o:
+        for i, line in enumerate(o):
+            fields = line.split('\t', max(chromcol, poscol) + 1)
+            chrom = fields[chromcol]
+            yield (ranks[chrom], int(fields[poscol]), num, i, chrom, line)
+
+
+def merge_pieces(piecefiles, columns, filename, ranks, index=True):
+    """
+    Merge sorted pieces into one genome-sorted file (and an indexed, bgzipped copy).
+    Only one row of each piece is in memory at a time.
+
+    Positional arguments:
+    piecefiles - list of paths from write_piece() (or from merge_pieces(index=False))
+    columns - list of column names for the header
+    filename - path to combined output file
+    ranks - dict from get_contig_order() (updated by write_piece())
+
+    Keyword arguments:
+    index - bool; write a header and an indexed, bgzipped copy - False for group files that are merged later
+    """
+    chromcol, poscol = columns.index('CHROM'), columns.index('POS')
+    pieces = [read_piece(num, piecefile, chromcol, poscol, ranks) for num, piecefile in enumerate(piecefiles)]
+    gzwriter = IndexedTableWriter(filename + '.gz', columns) if index is True else None
+    with open(filename, 'w') as o:
+        if index is True:
+            o.write('\t'.join(columns) + '\n')
+        for rank, pos, num, i, chrom, line in heapq.merge(*pieces):
+            o.write(line)
+            if gzwriter is not None:
+                gzwriter.write_line(line, chrom, pos)
+    if gzwriter is not None:
+        gzwriter.close()
+
+
+def iter_filtered(jobs, pool, inflight):
+    """
+    Yield filter_tablefile() results in job order without queueing every job on the pool at once.
+
+    Positional arguments:
+    jobs - list of args for filter_tablefile()
+    pool - multiprocessing.Pool or None to filter in this process
+    inflight - int; max number of jobs submitted to the pool whose results have not yet been yielded
+
+    Yields:
+    tuple from filter_tablefile()
+    """
+    if pool is None:
+        yield from map(filter_tablefile, jobs)
+        return
+    jobs = iter(jobs)
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(filter_tablefile, (job,)))
+        if len(pending) == inflight:
+            break
+    while pending:
+        result = pending.popleft().get()
+        # only submit the next job once a result has been handed off to be written
+        for job in jobs:
+            pending.append(pool.apply_async(filter_tablefile, (job,)))
+            break
+        yield result
+
+
+def filter_pieces(tablefiles, tipes, program, pooldir, piecedir, ranks, prof, workers=1):
+    """
+    Filter tablefiles for each tipe and write each filtered tablefile as a sorted piece (see write_piece()).
+
+    Positional arguments:
+    tablefiles - list of paths pointing to the gatk VariantsToTable .txt outputs from varscan or crisp vcf files
+    tipes - list of tipe; eg ["SNP", "INDEL"]
+    program - str; either "varscan" or "crisp" - used to find and name files
+    pooldir - path to pool directory
+    piecedir - directory to write pieces to
+    ranks - dict from get_contig_order()
+    prof - coadaptree.Profiler; records for each tablefile and piece are added to prof.records
+
+    Keyword arguments:
+    workers - int; number of processes to filter tablefiles with, results are kept in tablefile order
+        and at most 2*workers tablefiles are filtered or waiting to be written at any time
+
+    Returns:
+    piecefiles - dict with key = tipe, val = list of piece paths (in tablefile order)
+    columns - dict with key = tipe, val = list of column names
+    counts - dict with key = tipe, val = number of rows in the pieces
+    """
+    print(f'starting to filter {len(tablefiles)} tablefiles with {workers} worker(s)')
+    piecefiles = dict((tipe, []) for tipe in tipes)
+    columns = {}
+    counts = dict((tipe, 0) for tipe in tipes)
+    jobs = [(tablefile, tipes) for tablefile in tablefiles]
+    pool = Pool(workers) if workers > 1 else None
+    for i, (filtered, records) in enumerate(iter_filtered(jobs, pool, 2 * workers)):
+        prof.records.extend(records)
+        for tipe, df in filtered.items():
+            prof.context['tipe'] = tipe
+            if program == 'varscan':
+                df = prof.run('get_varscan_names', get_varscan_names, df, pooldir)
+            columns.setdefault(tipe, list(df.columns))
+            piecefiles[tipe].append(op.join(piecedir, f'{tipe}_{i:04}.txt'))
+            prof.run('write_piece', write_piece, df, piecefiles[tipe][-1], ranks)
+            counts[tipe] += len(df.index)
+        prof.context = {}
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return piecefiles, columns, counts
+
+
+def get_types(tablefiles, tipes, program, pooldir, grep, workers=1):
     """
     Use filter_VariantsToTable to filter based on tipe {SNP, INDEL}.
+    Each tablefile is loaded once and filtered for all tipes.
+    Filtered tablefiles are sorted and written to a piece file as they finish, then the pieces
+    are merged by reference contig order and POS, so memory is bounded by the largest tablefile.
 
     Positional arguments:
     tablefiles - list of paths pointing to the gatk VariantsToTable .txt outputs from varscan or crisp vcf files
-    tipe - str; either "SNP" or "INDEL"
+    tipes - list of tipe; eg ["SNP", "INDEL"]
+    program - str; either "varscan" or "crisp" - used to find and name files
+
+    Keyword arguments:
+    workers - int; number of processes to filter tablefiles with, results are kept in tablefile order
+    """
+    # opt-in stats (POOLSEQ_PROFILE=1), tablefile records include the stages from filter_VariantsToTable
+    prof = Profiler()
+    ranks = get_contig_order(pooldir)
+    piecedir = makedir(op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_pieces'))
+    piecefiles, columns, counts = filter_pieces(tablefiles, tipes, program, pooldir, piecedir, ranks, prof,
+                                                workers=workers)
+
+    for tipe in tipes:
+        filename = op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_{tipe}.txt')
+        print(f'merging {len(piecefiles[tipe])} {tipe} pieces ...')
+        prof.context['tipe'] = tipe
+        prof.run('merge_pieces', merge_pieces, piecefiles[tipe], columns[tipe], filename, ranks)
+        prof.annotate(rows_out=counts[tipe])
+        print(f'combined {program} files to {filename}')
+        print(f'final {tipe} count = {counts[tipe]}')
+    prof.context = {}
+    shutil.rmtree(piecedir)
+    prof.dump(op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_profile.json'),
+              pooldir=pooldir, program=program, tipes=tipes)
+
+
+def get_groupdir(pooldir, program, grep):
+    """Get the directory where group jobs write their sorted group files."""
+    return op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_groups')
+
+
+def combine_group(tablefiles, tipes, program, pooldir, grep, group, workers=1):
+    """
+    Filter and merge the tablefiles of one group into a sorted group file for each tipe (tree-reduction).
+    The group files are merged by merge_groups() once every group job has finished.
+
+    Positional arguments:
+    tablefiles - list of paths to the VariantsToTable outputs of the bedfiles in group
+    tipes - list of tipe; eg ["SNP", "INDEL"]
     program - str; either "varscan" or "crisp" - used to find and name files
+    group - int; group number (see get_groups())
+
+    Keyword arguments:
+    workers - int; number of processes to filter tablefiles with
     """
-    print(f'starting to filter {len(tablefiles)} tablefiles')
-    dfs = [filtvtt(tablefile, tipe, ret=True) for tablefile in tablefiles]
-    df = pd.concat(dfs)
+    prof = Profiler()
+    ranks = get_contig_order(pooldir)
+    groupdir = makedir(get_groupdir(pooldir, program, grep))
+    piecedir = makedir(op.join(groupdir, f'group_{group:04}_pieces'))
+    piecefiles, columns, counts = filter_pieces(tablefiles, tipes, program, pooldir, piecedir, ranks, prof,
+                                                workers=workers)
 
-    if program == 'varscan':
-        df = get_varscan_names(df, pooldir)
+    for tipe in tipes:
+        filename = op.join(groupdir, f'{tipe}_group_{group:04}.txt')
+        print(f'merging {len(piecefiles[tipe])} {tipe} pieces ...')
+        prof.context['tipe'] = tipe
+        prof.run('merge_pieces', merge_pieces, piecefiles[tipe], columns[tipe], filename, ranks, index=False)
+        prof.annotate(rows_out=counts[tipe])
+        print(f'{tipe} count for group {group} = {counts[tipe]}')
+    prof.context = {}
+    shutil.rmtree(piecedir)
+    # contigs not in the reference get ranks in order of appearance, keep them so merge_groups() can order them
+    pkldump({'columns': columns,
+             'counts': counts,
+             'contigs': sorted(ranks, key=ranks.get)}, op.join(groupdir, f'group_{group:04}.pkl'))
+    prof.dump(op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_group_{group:04}_profile.json'),
+              pooldir=pooldir, program=program, tipes=tipes, group=group)
 
-    print('writing df to file ...')
-    filename = op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_{tipe}.txt')
-    df.to_csv(filename, sep='\t', index=False)
 
-    print(f'combined {program} files to {filename}')
-    print(f'final {tipe} count = {len(df.index)}')
+def merge_groups(tipes, program, pooldir, grep, ngroups):
+    """
+    Merge the sorted group files from combine_group() into the final outputs (tree-reduction).
+
+    Positional arguments:
+    tipes - list of tipe; eg ["SNP", "INDEL"]
+    program - str; either "varscan" or "crisp" - used to find and name files
+    ngroups - int; number of group jobs
+    """
+    groupdir = get_groupdir(pooldir, program, grep)
+    groupfiles = [op.join(groupdir, f'group_{group:04}.pkl') for group in range(ngroups)]
+    missing = [f for f in groupfiles if not op.exists(f)]
+    if len(missing) > 0:
+        print('the following group files do not exist, exiting.\n\t' + '\n\t'.join(missing))
+        exit()
+    groups = [pklload(f) for f in groupfiles]
+    ranks = get_contig_order(pooldir)
+    for info in groups:
+        for contig in info['contigs']:
+            ranks.setdefault(contig, len(ranks))
+
+    prof = Profiler()
+    for tipe in tipes:
+        filename = op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_{tipe}.txt')
+        piecefiles = [op.join(groupdir, f'{tipe}_group_{group:04}.txt') for group in range(ngroups)]
+        count = sum([info['counts'][tipe] for info in groups])
+        print(f'merging {ngroups} {tipe} group files ...')
+        prof.context['tipe'] = tipe
+        prof.run('merge_pieces', merge_pieces, piecefiles, groups[0]['columns'][tipe], filename, ranks)
+        prof.annotate(rows_out=count)
+        print(f'combined {program} files to {filename}')
+        print(f'final {tipe} count = {count}')
+    prof.context = {}
+    shutil.rmtree(groupdir)
+    prof.dump(op.join(pooldir, f'{program}/{grep}-{program}_all_bedfiles_profile.json'),
+              pooldir=pooldir, program=program, tipes=tipes, ngroups=ngroups)
 
 
 def get_tables(files):
@@ -93,32 +407,46 @@ def get_tables(files):
     files - list of shfiles, should be same length as tablefiles (if all jobs are sbatched and done).
     """
     print('getting tablefiles')
+    # only the tablefiles of the bedfiles in files (eg the bedfiles of a group), keys are shfiles or task names
+    nums = [f.split("_bedfile_")[-1].replace(".sh", "") for f in files]
     tablefiles = [f for f in fs(op.join(pooldir, program))
                   if f.endswith('.txt')
                   and 'all_bedfiles' not in f
                   and 'SNP' not in f
                   and 'INDEL' not in f
-                  and grep in f]
+                  and grep in f
+                  and any(f'_bedfile_{num}_' in f for num in nums)]
     if not len(tablefiles) == len(files):
         print('for some reason tablefiles != files. exiting.')
         exit()
     return tablefiles
 
 
-def main():
+def main(group=None, ngroups=None):
+    if group == 'final':
+        # tree-reduction: all group jobs have finished (afterok), merge their group files
+        merge_groups(['SNP', 'INDEL'], program, pooldir, grep, ngroups)
+        return
+
     # make sure all of the crisp jobs have finished
-    files = checkjobs()
+    files = checkjobs(group, ngroups)
 
     # combine table files from output of VariantsToTable
     tablefiles = get_tables(files)
 
-    # get SNP and indels
-    for tipe in ['SNP', 'INDEL']:
-        get_types(tablefiles, tipe, program, pooldir, grep)
+    # get SNP and indels, reading each tablefile once
+    if group is None:
+        get_types(tablefiles, ['SNP', 'INDEL'], program, pooldir, grep, workers=workers)
+    else:
+        combine_group(tablefiles, ['SNP', 'INDEL'], program, pooldir, grep, group, workers=workers)
 
 
 if __name__ == '__main__':
     # for crisp grep = pool, for varscan grep = pool
-    thisfile, pooldir, program, grep = sys.argv
+    thisfile, pooldir, program, grep, *args = sys.argv
+    workers = get_workers(args[0] if len(args) > 0 else None)
+    group, ngroups = (None, None) if len(args) < 3 else (args[1], int(args[2]))
+    if group is not None and group != 'final':
+        group = int(group)
 
-    main()
+    main(group, ngroups)
@@ -2,17 +2,34 @@
 
 ### purpose
 # create bedfiles from reference so that we can parallelize CRISP
+# contigs are packed so that each bedfile has about the same number of bases,
+#     contigs longer than total/NBEDFILES are split across bedfiles
 # if an intervals directory exists, use that instead of ref.fa.length file (for stitched refs)
+# once a pool's reads are mapped, start_crispANDvarscan.py calls make_pool_bedfiles() to create bedfiles
+#     for the pool that are balanced by read counts (from samtools idxstats) instead
+#     (stitched refs keep their interval bedfiles)
 #
 
 ### usage
 # python create_bedfiles.py /path/to/reference.fasta
+# OR
+# python create_bedfiles.py /path/to/reference.fasta /path/to/pooldir [/path/to/realigned.bam ...]
+# (bedfiles balanced by the pool's reads are written to pooldir/bedfiles_{ref},
+#  without bamfiles reads are counted from the pool's .coord files, which is much slower)
 ###
 """
 
-import sys, os, math
+import sys, os, math, heapq, shutil, subprocess, pandas as pd
+from collections import Counter
 from os import path as op
-from coadaptree import fs, makedir
+from coadaptree import fs, makedir, Bcolors
+
+
+# number of bedfiles (parallel calling jobs) to spread the reference across
+NBEDFILES = 450
+
+# contigs are not split into intervals shorter than this (eg for small references)
+MIN_SPLIT = 1000000
 
 
 def openlenfile(lenfile):
@@ -27,22 +44,26 @@ def openlenfile(lenfile):
     return text
 
 
-def get_prereqs(num):
+def get_prereqs(num, beddir=None):
     """Create a name for a bedfile based on the ref.fa path name and num.
 
     Positional arguments:
     num - int; the num'th bedfile
+
+    Keyword arguments:
+    beddir - directory for the bedfile, default bedfiles_{ref} next to ref.fa
     """
     bname = op.basename(ref).split(".fa")[0]
-    beddir = makedir(op.join(op.dirname(ref), 'bedfiles_%s' % bname))
+    if beddir is None:
+        beddir = makedir(op.join(op.dirname(ref), 'bedfiles_%s' % bname))
     f = op.join(beddir, "%s_bedfile_%s.bed" % (bname, str(num).zfill(4)))
     return f
 
 
-def make_bed(lines, num):
+def make_bed(lines, num, beddir=None):
     """Write contig/chrom, start, stop positions to bedfile.
     Different than make_bedfile(): .list files use zero-based, no need to correct."""
-    f = get_prereqs(num)
+    f = get_prereqs(num, beddir)
     with open(f, 'w') as o:
         for contig, start, stop in lines:
             o.write("%s\t%s\t%s\n" % (contig, start, stop))
@@ -89,42 +110,230 @@ def make_lenfile():
         print("something went wrong with creating the ref.length file for %s\nexiting %s" % (ref, sys.argv[0]))
         exit()
 
-    # spread contigs across 450 bed files
+    # spread contigs across NBEDFILES bed files
     fcount = make_bedfiles()
 
     print('\t\tcreated %s bedfiles for %s' % (fcount, ref))
 
 
-def make_bedfile(lines, fcount):
-    """Use ref.fa.length file to write contig/chorm, start, stop to bedfile.
-    Different than make_bed(): ref.fa.length is 1-based, need to assert zero-based indexing.
+def get_intervals(text):
+    """Split contigs longer than the target number of bases per bedfile into equal sub-intervals.
 
     Positional arguments:
-    lines - list of tuples - zeroth element is contig/chrom name, first is length of contig/chrom
-    fcount - the fcount'th bedfile; used for naming file
+    text - list of lines from ref.fa.length (contig \t length)
+
+    Returns:
+    intervals - list of (contig, start, stop) tuples (zero-based, stop not included), in reference order
     """
-    f = get_prereqs(fcount)
-    with open(f, 'w') as o:
-        for line in lines:
-            contig, length = line
-            # length instead of length-1 is fine
-            o.write("%s\t%s\t%s\n" % (contig, 0, length))  # contig \t start \t stop
+    lengths = [line.split("\t") for line in text if not line == '']
+    lengths = [(contig, int(length)) for contig, length in lengths]
+    target = max(math.ceil(sum([length for contig, length in lengths]) / NBEDFILES), MIN_SPLIT)
+    intervals = []
+    for contig, length in lengths:
+        nsplits = math.ceil(length / target) if length > target else 1
+        bounds = [round(i * length / nsplits) for i in range(nsplits + 1)]
+        intervals.extend([(contig, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])])
+    return intervals
+
+
+def read_coords(coordfiles, window=MIN_SPLIT):
+    """Count reads in each window of each contig from bedtools bamtobed output.
+
+    Positional arguments:
+    coordfiles - list of paths to .coord files (see 02_bwa-map_view_sort_index_flagstat.py)
+
+    Keyword arguments:
+    window - int; window size in bp
+
+    Returns:
+    counts - Counter with key = (contig, window number), val = number of reads that start in window
+    """
+    counts = Counter()
+    for coordfile in coordfiles:
+        print('\tcounting reads in %s' % op.basename(coordfile))
+        for chunk in pd.read_csv(coordfile, sep='\t', header=None, usecols=[0, 1], names=['contig', 'start'],
+                                 dtype={'contig': str, 'start': int}, chunksize=5000000):
+            counts.update(chunk.groupby([chunk['contig'], chunk['start'] // window]).size().to_dict())
+    return counts
+
+
+def read_idxstats(bamfiles, window=MIN_SPLIT):
+    """Count reads in each window of each contig from the bam indexes (samtools idxstats).
+    The index only has counts per contig, reads are spread evenly across the windows of a contig.
+
+    Positional arguments:
+    bamfiles - list of paths to indexed bamfiles
+
+    Keyword arguments:
+    window - int; window size in bp
+
+    Returns:
+    counts - Counter with key = (contig, window number), val = number of reads in window
+    """
+    counts = Counter()
+    for bam in bamfiles:
+        print('\tgetting idxstats for %s' % op.basename(bam))
+        stats = subprocess.check_output([shutil.which('samtools'), 'idxstats', bam]).decode('utf-8').split('\n')
+        for line in stats:
+            if not line.count('\t') == 3:
+                continue
+            contig, length, mapped, unmapped = line.split('\t')
+            length, mapped = int(length), int(mapped)
+            if contig == '*' or mapped == 0:
+                continue
+            for w in range(math.ceil(length / window)):
+                counts[(contig, w)] += mapped * (min(length, (w + 1) * window) - w * window) / length
+    return counts
+
+
+def get_weighted_intervals(text, counts, window=MIN_SPLIT):
+    """Split contigs with more than the target number of reads per bedfile at window boundaries.
+
+    Positional arguments:
+    text - list of lines from ref.fa.length (contig \t length)
+    counts - Counter from read_coords() or read_idxstats()
+
+    Keyword arguments:
+    window - int; window size in bp used for counts
+
+    Returns:
+    intervals - list of (contig, start, stop) tuples (zero-based, stop not included), in reference order
+    weights - list of the number of reads in each interval
+    """
+    lengths = [line.split("\t") for line in text if not line == '']
+    target = sum(counts.values()) / NBEDFILES
+    intervals, weights = [], []
+    for contig, length in lengths:
+        length = int(length)
+        start, reads = 0, 0
+        for w in range(math.ceil(length / window)):
+            reads += counts.get((contig, w), 0)
+            stop = min(length, (w + 1) * window)
+            if reads >= target or stop == length:
+                intervals.append((contig, start, stop))
+                weights.append(reads)
+                start, reads = stop, 0
+    return intervals, weights
+
+
+def pack_intervals(intervals, nbins, weights=None):
+    """Assign intervals to nbins bins with about equal total weight (longest processing time first).
+
+    Positional arguments:
+    intervals - list of (contig, start, stop) tuples from get_intervals() or get_weighted_intervals()
+    nbins - number of bins (bedfiles)
+
+    Keyword arguments:
+    weights - list of the expected work for each interval (eg reads), default number of bases
+
+    Returns:
+    bins - list of lists of intervals, intervals of each bin are in reference order
+    """
+    if weights is None:
+        weights = [stop - start for contig, start, stop in intervals]
+    # each interval goes to the bin with the least weight so far, from heaviest to lightest interval
+    order = sorted(range(len(intervals)), key=lambda i: weights[i], reverse=True)
+    heap = [(0, fcount) for fcount in range(nbins)]
+    bins = [[] for fcount in range(nbins)]
+    for i in order:
+        weight, fcount = heapq.heappop(heap)
+        bins[fcount].append(i)
+        heapq.heappush(heap, (weight + weights[i], fcount))
+    return [[intervals[i] for i in sorted(b)] for b in bins]
 
 
 def make_bedfiles():
-    """Use ref.fa.length file to create bedfiles."""
+    """Use ref.fa.length file to create bedfiles with about equal total bases."""
     text = openlenfile("%s.length" % ref)
-    thresh = math.ceil(len(text) / 450)
-    lines = []
-    fcount = 0
-    for count, line in enumerate(text):
-        if not line == '':
-            lines.append(line.split("\t"))
-        if len(lines) == thresh or (count + 1 == len(text)):
-            make_bedfile(lines, fcount)
-            lines = []
-            fcount += 1
-    return fcount
+    intervals = get_intervals(text)
+    bins = pack_intervals(intervals, min(NBEDFILES, len(intervals)))
+    # write to a temporary dir and swap it in so bedfiles from an earlier layout (eg with more bedfiles) are removed
+    beddir = op.join(op.dirname(ref), 'bedfiles_%s' % op.basename(ref).split(".fa")[0])
+    tmpdir = '%s.tmp' % beddir
+    if op.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    makedir(tmpdir)
+    for fcount, lines in enumerate(bins):
+        make_bed(lines, fcount, tmpdir)
+    if op.exists(beddir):
+        shutil.rmtree(beddir)
+    os.replace(tmpdir, beddir)
+    return len(bins)
+
+
+def get_pool_beddir(ref, pooldir):
+    """Get the path to the pool's bedfiles balanced by read counts (see make_pool_bedfiles())."""
+    return op.join(pooldir, 'bedfiles_%s' % op.basename(ref).split(".fa")[0])
+
+
+def fall_back(ref, pooldir, reason):
+    """Warn that the pool will use the bedfiles for ref, remove any pool bedfiles from an earlier run.
+
+    Positional arguments:
+    ref - path to ref.fa
+    pooldir - path to pool directory
+    reason - str; why the pool's bedfiles could not be created
+    """
+    warning = 'WARN: %s, using the bedfiles for %s for %s' % (reason, op.basename(ref), op.basename(pooldir))
+    print(Bcolors.WARNING + warning + Bcolors.ENDC)
+    # otherwise start_crispANDvarscan.get_bedfiles() would use a stale partition
+    beddir = get_pool_beddir(ref, pooldir)
+    if op.exists(beddir):
+        print('\tremoving bedfiles from an earlier run: %s' % beddir)
+        shutil.rmtree(beddir)
+    return None
+
+
+def make_pool_bedfiles(ref, pooldir, bamfiles=None):
+    """Create bedfiles for a pool with about equal numbers of reads (expected pileup work) in each.
+    Reads are counted from the bam indexes of bamfiles, or from the pool's .coord files if bamfiles is None.
+    Stitched refs (with an intervals dir) keep the bedfiles made from their intervals.
+
+    Positional arguments:
+    ref - path to ref.fa
+    pooldir - path to pool directory, bedfiles are written to pooldir/bedfiles_{ref}
+
+    Keyword arguments:
+    bamfiles - list of paths to the pool's indexed bamfiles
+
+    Returns:
+    beddir - path to the pool's bedfiles, None if reads or ref.fa.length could not be found
+    """
+    globals().update({'ref': ref})
+    print('creating bedfiles for %s balanced by read counts' % op.basename(pooldir))
+    lenfile = "%s.length" % ref
+    if op.exists(op.join(op.dirname(ref), 'intervals')):
+        return fall_back(ref, pooldir, 'ref is stitched (bedfiles are made from its intervals)')
+    if not op.exists(lenfile):
+        return fall_back(ref, pooldir, 'could not find %s' % lenfile)
+    if bamfiles is not None:
+        # the index has counts per contig - fast enough to run in the job that starts calling
+        if shutil.which('samtools') is None:
+            return fall_back(ref, pooldir, 'samtools is not loaded (module load samtools/1.9)')
+        counts = read_idxstats(bamfiles)
+    else:
+        sortdir = op.join(pooldir, '02c_sorted_bamfiles')
+        coordfiles = [f for f in fs(sortdir) if f.endswith('bam.coord')] if op.exists(sortdir) else []
+        counts = read_coords(coordfiles)
+    if sum(counts.values()) == 0:
+        return fall_back(ref, pooldir, 'could not count reads')
+
+    intervals, weights = get_weighted_intervals(openlenfile(lenfile), counts)
+    bins = pack_intervals(intervals, min(NBEDFILES, len(intervals)), weights)
+    # write to a temporary dir so that a partial partition is never used (see start_crispANDvarscan.get_bedfiles)
+    # and bedfiles from a previous partition, which could have had more bedfiles, are removed
+    beddir = get_pool_beddir(ref, pooldir)
+    tmpdir = '%s.tmp' % beddir
+    if op.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    makedir(tmpdir)
+    for fcount, lines in enumerate(bins):
+        make_bed(lines, fcount, tmpdir)
+    if op.exists(beddir):
+        shutil.rmtree(beddir)
+    os.replace(tmpdir, beddir)
+    print('\t\tcreated %s bedfiles for %s' % (len(bins), op.basename(pooldir)))
+    return beddir
 
 
 def main(ref):
@@ -135,5 +344,8 @@ def main(ref):
 
 if __name__ == "__main__":
     # args
-    thisfile, ref = sys.argv
-    main(ref)
+    thisfile, ref, *args = sys.argv
+    if len(args) > 0:
+        make_pool_bedfiles(ref, args[0], args[1:] if len(args) > 1 else None)
+    else:
+        main(ref)
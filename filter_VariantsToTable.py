@@ -15,38 +15,35 @@
 ###
 
 ### usage
-# python filter_VariantsToTable.py SNPorINDEL
+# python filter_VariantsToTable.py tablefile SNPorINDEL [chunksize]
+# (chunksize - stream tablefile in chunks of ~chunksize rows to limit memory)
+# (SNPorINDEL can be SNP,INDEL - load tablefile once and write both, results are also cached
+#  as {tablefile}_{tipe}_filtered.pkl so that combine_crispORvarscan.py does not filter again)
+# (export POOLSEQ_PROFILE=1 to write per-stage time/memory/row counts to {tablefile}_{tipe}_profile.json)
 # OR
 # from filter_VariantsToTable import main as remove_multiallelic
+# OR
+# from filter_VariantsToTable import filter_types  # load once, filter for SNP and INDEL
 ###
 """
 
-import sys, pandas as pd, numpy as np, math
-from tqdm import tqdm
-from coadaptree import uni, pklload
+import os, sys, pandas as pd, numpy as np, math
+from coadaptree import pklload, pkldump, fingerprint, Profiler
 from os import path as op
-from collections import Counter
 
 
-def table(lst):
-    """
-    Count each item in a list.
-    
-    Returns:
-    - Counter() with key = item, val = count
-    """
-    c = Counter()
-    for x in lst:
-        c[x] += 1
-    return c
+# varscan reports pool FREQ to (at most) two decimals, float32 .FREQ columns hold that exactly once rounded
+FREQ_DECIMALS = 2
 
+# pool freqs with GQ < MIN_GQ are masked, loci with >= MAX_MISSING of pools missing are removed
+MIN_GQ = 20
+MAX_MISSING = 0.25
 
-def get_copy(df, cols):
-    """
-    Transpose dataframe using specific columns (that will be index after transformation).
-    Doing so helps speed things up.
-    """
-    return df[cols].T.copy()
+# bump when parsed or filtered output changes (eg new columns or dtypes) so that existing caches are rebuilt
+CACHE_VERSION = 1
+
+# opt-in per-stage stats, set POOLSEQ_PROFILE=1 to write {tablefile}_{tipe}_profile.json (see coadaptree.Profiler)
+profiler = Profiler()
 
 
 def get_freq_cutoffs(tablefile):
@@ -77,216 +74,309 @@ def get_freq_cutoffs(tablefile):
     return lowfreq, highfreq, ploidy
 
 
-def filter_freq(df, tf, tipe, tablefile):
+def get_matrix(df, cols, decimals=None):
+    """
+    Parse columns of df into a 2-D float array, one row per column and one column per locus.
+    Same orientation as a transposed df[cols], but each column is parsed only once.
+    Strips '%' from varscan .FREQ columns (values stay as percentages).
+
+    Positional arguments:
+    df - pandas.dataframe; VariantsToTable output
+    cols - list of columns in df to parse (eg .FREQ or .GQ columns)
+
+    Keyword arguments:
+    decimals - int; round values to this many decimals (eg to undo float32 storage of varscan .FREQ)
+
+    Returns:
+    mat - numpy.ndarray with shape (len(cols), len(df.index)); np.nan where data is missing
+    """
+    mat = np.empty((len(cols), len(df.index)), dtype=float)
+    for i, col in enumerate(cols):
+        try:
+            mat[i] = df[col].astype('float')
+        except ValueError:
+            # '45.5%' or a mix of str and float (eg after concat with REF=N loci)
+            mat[i] = df[col].astype(str).str.rstrip('%').astype('float')
+    if decimals is not None:
+        mat = np.round(mat, decimals)
+    return mat
+
+
+def get_global_freqs(freqs):
+    """
+    Calculate global freq for each locus as the mean of non-missing pool freqs.
+
+    Positional arguments:
+    freqs - numpy.ndarray; .FREQ matrix (in percent) from get_matrix()
+
+    Returns:
+    globfreqs - numpy.ndarray of len(loci); np.nan for loci with all freqs masked
+    """
+    isnan = np.isnan(freqs)
+    counts = (~isnan).sum(axis=0)
+    # add one pool at a time so each locus is summed in the same order as sum() (.sum(axis=0) may not)
+    sums = np.zeros(freqs.shape[1])
+    for row in np.where(isnan, 0, freqs):
+        sums += row
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # avoid loci with all freqs masked (0/0 = nan)
+        globfreqs = sums / (100 * counts)
+    return globfreqs
+
+
+def filter_freq(freqs, tf, tipe, tablefile, keep=None):
     """
     Filter out loci with global MAF < 1/(ploidyPerPop * nPops).
     Right now this is unnecessary for varscan when setting pool-level freq to 1/ploidy.
     
     Positional arguments:
-    df - pandas.dataframe; VariantsToTable output
-    tablefile - path to VariantsToTable output - used to find ploidy etc
+    freqs - numpy.ndarray; .FREQ matrix from get_matrix() (in percent)
     tf - str; basename of tablefile
     tipe - str; one of either "SNP" or "INDEL"
+    tablefile - path to VariantsToTable output - used to find ploidy etc
+
+    Keyword arguments:
+    keep - boolean numpy.ndarray; loci that passed previous filters (default all loci)
     
     Returns:
-    df - pandas.dataframe; freq-filtered VariantsToTable output
+    keep - boolean numpy.ndarray; True for loci that passed previous filters and freq filter
+    globfreqs - numpy.ndarray; global freq of each locus
     """
-    # believe it or not, it's faster to do qual and freq filtering in two steps vs an 'and' statement
     lowfreq, highfreq, ploidy = get_freq_cutoffs(tablefile)
     print(f'filtering for global frequency ({lowfreq}, {highfreq})...')
-    df.reset_index(drop=True, inplace=True)
-    
-    # prep for filtering
-    freqcols = [col for col in df.columns if '.FREQ' in col]
-    
+
     # carry on with poolseq datas
-    filtloci = []
-    afs = []
-    copy = get_copy(df, freqcols)
-    for locus in tqdm(copy.columns):
-        freqs = [x for x
-                 in copy[locus].str.rstrip('%').astype('float')
-                 if not math.isnan(x)]  # faster than ...str.rstrip('%').astype('float').dropna()
-        if len(freqs) > 0:  # avoid loci with all freqs masked (avoid ZeroDivisionError)
-            globfreq = sum(freqs)/(100*len(freqs))
-            if lowfreq <= globfreq <= highfreq:
-                filtloci.append(locus)
-                afs.append(globfreq)  # since we're going in order of rows in df, we can use afs to replace AF col later
-                # which is about 40x faster than: df.loc[locus, 'AF'] = globfreq
-    print(f'{tf} has {len(filtloci)} {tipe}s that have global MAF > {lowfreq*100}%')
-    df = df[df.index.isin(filtloci)].copy()
-    df.index = range(len(df.index))
-    df['AF'] = afs
-    return df
+    globfreqs = get_global_freqs(freqs)
+    with np.errstate(invalid='ignore'):
+        passed = (lowfreq <= globfreqs) & (globfreqs <= highfreq)  # nan (all freqs masked) is never kept
+    keep = passed if keep is None else keep & passed
+    print(f'{tf} has {keep.sum()} {tipe}s that have global MAF > {lowfreq*100}%')
+    return keep, globfreqs
+
+
+def filter_af(afs, tablefile, keep):
+    """
+    Keep loci with MAF <= AF <= 1-MAF.
+
+    Positional arguments:
+    afs - numpy.ndarray; global AF from recalc_global_freq()
+    tablefile - path to VariantsToTable output - used to find ploidy etc
+    keep - boolean numpy.ndarray; loci that passed previous filters
+
+    Returns:
+    keep - boolean numpy.ndarray; True for loci that passed previous filters and AF filter
+    """
+    lowfreq, highfreq, ploidy = get_freq_cutoffs(tablefile)
+    with np.errstate(invalid='ignore'):
+        keep = keep & (afs <= highfreq) & (afs >= lowfreq)
+    print(f'{op.basename(tablefile)} has {keep.sum()} loci with MAF > {lowfreq}')
+    return keep
 
 
-def filter_missing_data(df, tf, tipe):
+def filter_missing_data(freqs):
     """
-    Remove loci with < 25% missing data.
-    Count np.nan in .FREQ col to assess % missing data.
+    Find loci with < 25% missing data.
+    Count np.nan in .FREQ to assess % missing data.
     
     Positional arguments:
-    df - pandas.dataframe; VariantsToTable output
-    tf - str; basename of tablefile
-    tipe - str; one of either "SNP" or "INDEL"
+    freqs - numpy.ndarray; .FREQ matrix from get_matrix(), shape = (num pools, num loci)
     
     Returns:
-    df - pandas.dataframe; missing data-filtered VariantsToTable output
+    keep - boolean numpy.ndarray; True for loci with < 25% missing data
     """
-    freqcols = [col for col in df.columns if '.FREQ' in col]
-    copy = get_copy(df, freqcols)
-    keepers = []
     # else statement for running single pop (megagamtophyte) through:
-    thresh = math.floor(0.25 * len(freqcols)) if len(freqcols) > 1 else 1
-    for locus in tqdm(copy.columns):
-        # if there is less than 25% missing data:
-        # the only time x != x is when x is nan (fastest way to count it)
-        count = sum(1 for x in copy[locus] if x != x)
-        if count < thresh:
-            keepers.append(locus)
-    df = df[df.index.isin(keepers)].copy()
-    df.index = range(len(df.index))
-    return df
+    thresh = math.floor(MAX_MISSING * freqs.shape[0]) if freqs.shape[0] > 1 else 1
+    # if there is less than 25% missing data:
+    return np.isnan(freqs).sum(axis=0) < thresh
+
+
+def mask_qual(df):
+    """
+    Mask freqs that have GQ < 20.
+
+    Positional arguments:
+    df - pandas.dataframe; .GQ and .FREQ columns of VariantsToTable output
+
+    Returns:
+    freqs - numpy.array; masked freqs, shape = (num pools, num loci)
+    badqual - boolean numpy.array; True where GQ < 20, same shape as freqs
+    """
+    gqcols = [col for col in df.columns if '.GQ' in col]
+    freqcols = [col.replace(".GQ", ".FREQ") for col in gqcols]
+    print(f'masking bad freqs for {len(gqcols)} pools...')
+    gqs = get_matrix(df, gqcols)
+    freqs = get_matrix(df, freqcols, decimals=FREQ_DECIMALS)
+    # badqual True if qual < 20 (nan GQ is not masked)
+    with np.errstate(invalid='ignore'):
+        badqual = gqs < MIN_GQ
+    freqs[badqual] = np.nan
+    return freqs, badqual
 
 
 def filter_qual(df, tf, tipe, tablefile):
     """
-    mask freqs that have GQ < 20.
+    mask freqs that have GQ < 20, then filter for missing data and global freq.
     
     Positional arguments:
-    df - pandas.dataframe; VariantsToTable output
+    df - pandas.dataframe; .GQ and .FREQ columns of VariantsToTable output
     tf - str; basename of tablefile
     tipe - str; one of either "SNP" or "INDEL"
+    tablefile - path to VariantsToTable output - used to find ploidy etc
     
-    Returns: pandas.dataframe; quality-filtered VariantsToTable output
-    - FREQ and GT are masked (np.nan) if GQ < 20
+    Returns:
+    keep - boolean numpy.ndarray; True for loci that passed all filters
+    badqual - boolean numpy.ndarray; True where FREQ should be masked (np.nan) because GQ < 20
+    globfreqs - numpy.ndarray; global freq of each locus (None if no loci have enough data)
     """
-    gqcols = [col for col in df.columns if '.GQ' in col]
-    print(f'masking bad freqs for {len(gqcols)} pools...')
-    for col in tqdm(gqcols):
-        freqcol = col.replace(".GQ", ".FREQ")
-#         gtcol = col.replace(".GQ", ".GT")  # pretty sure this is depricated
-        # badloci True if qual < 20
-#         df.loc[df[col] < 20, [freqcol, gtcol]] = np.nan
-        df.loc[df[col] < 20, freqcol] = np.nan
+    freqs, badqual = profiler.run('mask_qual', mask_qual, df)
 
     print('filtering for missing data ...')
-    df = filter_missing_data(df, tf, tipe)
+    keep = profiler.run('filter_missing_data', filter_missing_data, freqs)
 
-    if len(df.index) > 0:
-        print(f'{tf} has {len(df.index)} {tipe}s that have GQ >= 20 and < 25% missing data')
-        df = filter_freq(df, tf, tipe, tablefile)
-        df.index = range(len(df.index))
+    globfreqs = None
+    if keep.any():
+        print(f'{tf} has {keep.sum()} {tipe}s that have GQ >= {MIN_GQ} and < {MAX_MISSING:.0%} missing data')
+        keep, globfreqs = profiler.run('filter_freq', filter_freq, freqs, tf, tipe, tablefile, keep=keep)
     else:
-        print(f'{tf} did not have any {tipe}s that have GQ >= 20 for >= 75% of pops' +
+        print(f'{tf} did not have any {tipe}s that have GQ >= {MIN_GQ} for >= {1 - MAX_MISSING:.0%} of pops' +
               '\nnot bothering to filter for freq')
-#         df = drop_freq_cols(df)
-    return df
+    return keep, badqual, globfreqs
 
 
-def adjust_freqs(smalldf):
+def adjust_freqs(first, second):
     """
     For loci with REF=N, set freqs of pools with REF=N in GT to np.nan.
     Set alt freqs with respect to the second alt allele.
     
     Positional arguments:
-    smalldf - pandas.dataframe; df with only REF=N
+    first - pandas.dataframe; zeroth row of each REF=N locus
+    second - pandas.dataframe; first row of each REF=N locus (same index as first)
     
     Returns:
-    ndf - smalldf with adjusted freqs in zeroth row
+    first - pandas.dataframe; zeroth rows with adjusted freqs
     """
-    gtcols = [col for col in smalldf.columns if 'GT' in col]
+    gtcols = [col for col in first.columns if 'GT' in col]
 
     for col in gtcols:
-        gt = smalldf.loc[1, col]
-        if isinstance(gt, str):
-            freqcol = col.split(".")[0] + '.FREQ'
-            if not gt == 'N/N':
-                freq = smalldf.loc[0, freqcol]
-                if isinstance(freq, str):
-                    if "%" in freq:
-                        newfreq = "%s%%" % (100 - float(freq.split("%")[0]))
-                        smalldf.loc[0, freqcol] = newfreq
-            else:
-                # if gt = N/N, adjust to undefined
-                smalldf.loc[1, freqcol] = np.nan
-        gt2 = smalldf.loc[0, col]
-        if isinstance(gt2, str):
-            if gt == 'N/N':
-                # if gt = N/N, adjust to undefined
-                smalldf.loc[0, freqcol] = np.nan
-    return smalldf
-
-
-def get_refn_snps(df, tipe, ndfs=None):
+        freqcol = col.split(".")[0] + '.FREQ'
+        if freqcol not in first.columns:
+            continue
+        hasgt = second[col].notnull()
+        isnn = hasgt & (second[col] == 'N/N')
+        # if gt != N/N, set freq (percent) with respect to the second alt allele
+        adjust = hasgt & ~isnn & first[freqcol].notnull()
+        first.loc[adjust, freqcol] = 100 - first.loc[adjust, freqcol]
+        # if gt = N/N, adjust to undefined
+        first.loc[isnn & first[col].notnull(), freqcol] = np.nan
+    return first
+
+
+def get_refn_snps(df, tipe):
     """
     Isolate polymorphisms with REF=N but two ALT single nuleodite alleles.
     
     Positional arguments:
     df - pandas.dataframe; current filtered VariantsToTable output
+    tipe - str; one of either "SNP" or "INDEL"
     
     Returns:
-    dfs - list of loci (pandas.dataframes) with REF=N and two ALT alleles, counts with respect to second ALT
-    ndfs - return from pd.conat(dfs)
+    ndfs - pandas.dataframe; one row per locus with REF=N and two ALT alleles, counts with respect to second ALT
     """
     # as far as I can tell, crisp output from convert_pooled_vcf.py will not output REF = N
-    ndf = df[df['REF'] == 'N'].copy()
-    ndf = ndf[ndf['TYPE'] == tipe].copy()
-    ncount = table(ndf['locus'])
-    nloci = [locus for locus in ncount if ncount[locus] == 2]
-    ndf = ndf[ndf['locus'].isin(nloci)].copy()
-    dfs = []
-    for locus in uni(ndf['locus']):
-        smalldf = ndf[ndf['locus'] == locus].copy()
-        if len(smalldf.index) == 2:
-            smalldf.index = range(len(smalldf.index))
-            smalldf = adjust_freqs(smalldf)
-            smalldf.loc[0,'ALT'] = "%s+%s" % (smalldf.loc[0,'ALT'], smalldf.loc[1,"ALT"])
-            dfs.append(pd.DataFrame(smalldf.loc[0,:]).T)
-    if len(dfs) > 0:
-        ndfs = pd.concat(dfs)
-    return (dfs, ndfs)
+    ndf = df[(df['REF'] == 'N') & (df['TYPE'] == tipe)]
+    ncount = ndf.groupby('locus')['locus'].transform('size')
+    ndf = ndf[ncount == 2]
+    # put the two rows of each locus next to each other, loci in order of appearance
+    order = np.argsort(pd.factorize(ndf['locus'])[0], kind='mergesort')
+    ndf = ndf.iloc[order]
+    first = ndf.iloc[0::2].copy()
+    second = ndf.iloc[1::2].copy()
+    first.index = range(len(first.index))
+    second.index = range(len(second.index))
+    ndfs = adjust_freqs(first, second)
+    ndfs['ALT'] = ndfs['ALT'].astype(str) + '+' + second['ALT'].astype(str)
+    return ndfs
+
+
+def get_allele_counts(df, gtcols):
+    """
+    Decode crisp genotypes one pool at a time.
+    Counts occurrences of each locus' REF and ALT in every GT string (eg 'A/A/A/T').
 
+    Positional arguments:
+    df - pandas.dataframe; current filtered VariantsToTable output
+    gtcols - list of .GT columns in df
 
-def recalc_global_freq(df, tf, freqcols):
+    Returns:
+    refcounts - numpy.ndarray with shape (len(gtcols), len(df.index)); np.nan where GT is missing
+    altcounts - numpy.ndarray with shape (len(gtcols), len(df.index)); np.nan where GT is missing
+    """
+    refs = np.asarray(df['REF'], dtype=str)
+    alts = np.asarray(df['ALT'], dtype=str)
+    refcounts = np.empty((len(gtcols), len(df.index)), dtype=float)
+    altcounts = np.empty((len(gtcols), len(df.index)), dtype=float)
+    # only one pool's GT strings are converted to a fixed-width array at a time
+    for i, col in enumerate(gtcols):
+        gts = np.asarray(df[col], dtype=object)
+        missing = pd.isnull(gts)
+        gts = np.where(missing, '', gts).astype(str)
+        refcounts[i] = np.char.count(gts, refs)
+        altcounts[i] = np.char.count(gts, alts)
+        refcounts[i, missing] = np.nan
+        altcounts[i, missing] = np.nan
+    return refcounts, altcounts
+
+
+def recalc_global_freq(freqs, afs):
     """
     For some reason AF reported by crisp is a little off. Recalc.
-    Moves crisp AF column to 'crisp_AF'.
-    Recalulates global AF (alt), save as AF column.
+    Recalulates global AF (alt) as the mean of non-missing pool freqs.
     
     Positional arguments:
-    df - pandas.dataframe; current filtered VariantsToTable output
-    tf - basename of file path of df
-    freqcols - columns in VariantsToTable output pandas.dataframe with ".FREQ" in them
+    freqs - numpy.ndarray; pool freqs from get_pool_freqs()
+    afs - numpy.ndarray; AF reported by crisp, kept for loci where all pool freqs are missing
     
     Returns:
-    df - pandas.dataframe; global freq-filtered VariantsToTable output
+    afs - numpy.ndarray; recalculated global AF
     """
     print('Recalculating global freq ... ')
-    df.index = range(len(df.index))
-    df['crisp_AF'] = df['AF']
-    copy = get_copy(df, freqcols)
-    for locus in tqdm(copy):
-        denom = sum(~copy[locus].isnull())  # num of non-NA
-        if denom > 0:
-            num = np.nansum(copy[locus])
-            res = round(num/denom, 6)
-            df.loc[locus,'AF'] = res
-        else:
-            # all pops have NaN for .FREQ
-            # will get filtered later when looking @ missing data
-            pass
-    return df
+    denoms = (~np.isnan(freqs)).sum(axis=0)  # num of non-NA
+    # one row per locus so each locus is summed the same way np.nansum() sums a single locus
+    nums = np.nansum(np.ascontiguousarray(freqs.T), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        newafs = np.round(nums / denoms, 6)
+    # if all pops have NaN for .FREQ keep crisp AF, will get filtered later when looking @ missing data
+    return np.where(denoms > 0, newafs, afs)
+
+
+def get_pool_freqs(df):
+    """
+    Calculate pool-level (alt) freqs from crisp genotypes.
+
+    Positional arguments:
+    df - pandas.dataframe; REF, ALT, and .GT columns of VariantsToTable output
 
-def add_freq_cols(df, tf, tipe, tablefile):
+    Returns:
+    freqs - numpy.ndarray with shape (num .GT columns, num loci); np.nan where GT is missing
+    """
+    gtcols = [col for col in df.columns if '.GT' in col]
+    print('len(gtcols) = ', len(gtcols))
+    refcounts, altcounts = get_allele_counts(df, gtcols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freqs = altcounts / (altcounts + refcounts)
+    return freqs
+
+
+def add_freq_cols(df, tf, freqs, afs):
     """
     Adding in .FREQ columns for crisp file.
+    Moves crisp AF column to 'crisp_AF', recalculated AF is saved as AF column.
     
     Positional arguments:
     df - pandas.dataframe; current filtered VariantsToTable output
-    tablefile - path to VariantsToTable output - used to find ploidy etc
     tf - basename of tablefile
-    tipe - one of either "SNP" or "INDEL"
+    freqs - numpy.ndarray; pool freqs of df from get_pool_freqs()
+    afs - numpy.ndarray; global AF of df from recalc_global_freq()
     
     Returns:
     df - pandas.dataframe; current filtered VariantsToTable output + freqcols
@@ -296,26 +386,11 @@ def add_freq_cols(df, tf, tipe, tablefile):
     bednum = tf.split("file_")[-1].split("_converted")[0]
     df.columns = [col.replace("_" + bednum, "") for col in df.columns]
     # add in a .FREQ column for pool-level freqs
-    gtcols = [col for col in df.columns if '.GT' in col]
-    print('len(gtcols) = ', len(gtcols))
-    freqcols = []
-    for col in tqdm(gtcols):
-        refcol  = col.replace(".GT", ".REFCOUNT")
-        altcol  = col.replace(".GT", ".ALTCOUNT")
-        freqcol = col.replace(".GT", ".FREQ")
-        freqcols.append(freqcol)
-        for alt in uni(df['ALT']):
-            df.loc[df['ALT'] == alt, altcol] = df[col].str.count(alt)
-        for ref in uni(df['REF']):
-            df.loc[df['REF'] == ref, refcol] = df[col].str.count(ref)
-        df[freqcol] = df[altcol] / (df[altcol] + df[refcol])
-    # remove count cols
-    print('Removing unnecessary cols ...')
-    df = df[[col for col in df.columns
-             if '.REFCOUNT' not in col
-             and '.ALTCOUNT' not in col]].copy()
-    # recalculate global AF
-    df = recalc_global_freq(df, tf, freqcols)
+    freqcols = [col.replace(".GT", ".FREQ") for col in df.columns if '.GT' in col]
+    freqdf = pd.DataFrame(freqs.T, columns=freqcols, index=df.index)
+    df = pd.concat([df[[col for col in df.columns if col not in freqcols]], freqdf], axis=1)
+    df['crisp_AF'] = df['AF']
+    df['AF'] = afs
     # sort columns to group data together for each pool
     datacols = sorted([col for col in df.columns if '.' in col])
     othercols = [col for col in df.columns
@@ -323,9 +398,7 @@ def add_freq_cols(df, tf, tipe, tablefile):
                  and col != 'locus'
                  and 'crisp' not in col]
     othercols.insert(othercols.index('AF') + 1, 'crisp_AF')
-    df = df[['locus'] + othercols + datacols].copy()
-    df.index = range(len(df.index))
-    return df
+    return df[['locus'] + othercols + datacols]
 
 
 def write_file(tablefile, df, tipe):
@@ -335,12 +408,147 @@ def write_file(tablefile, df, tipe):
     print('finished filtering VariantsToTable file: %s' % newfile)
 
 
-def load_data(tablefile):
+def get_dtypes(tablefile):
+    """
+    Get compact dtypes for the columns of the VariantsToTable output.
+    .FREQ columns are read as str so that parse_freqs() can strip the '%'.
+
+    Positional arguments:
+    tablefile - path to VariantsToTable output
+
+    Returns:
+    dtypes - dict with key = column, val = dtype (for pandas.read_csv)
+    """
+    columns = pd.read_csv(tablefile, sep='\t', nrows=0).columns
+    dtypes = {'CHROM': 'category', 'POS': 'int32'}
+    for col in columns:
+        if '.GQ' in col:
+            dtypes[col] = 'float32'
+        elif '.FREQ' in col:
+            dtypes[col] = str
+    return dtypes
+
+
+def parse_freqs(df):
+    """Strip '%' from varscan .FREQ columns, keep as float32 percentages."""
+    for col in df.columns:
+        if '.FREQ' in col:
+            df[col] = df[col].str.rstrip('%').astype('float32')
+    return df
+
+
+def add_locus(df):
+    """
+    Create an integer locusID from CHROM-POS.
+    The contig's category code is in the upper 32 bits, POS is in the lower 32 bits.
+    """
+    df['CHROM'] = df['CHROM'].astype('category')
+    codes = df['CHROM'].cat.codes.values.astype('int64')
+    df['locus'] = (codes << 32) | df['POS'].values.astype('int64')
+    return df
+
+
+def format_output(df, tf):
+    """
+    Convert the compact columns back to text before writing.
+    - locus to CHROM-POS
+    - varscan .FREQ to percentages (eg '45.5%')
+    """
+    df['locus'] = df['CHROM'].astype(str) + '-' + df['POS'].astype(str)
+    if 'varscan' in tf:
+        for col in df.columns:
+            if '.FREQ' in col:
+                freqs = np.round(df[col].values.astype(float), FREQ_DECIMALS)
+                df[col] = pd.Series(np.char.mod('%g%%', freqs), index=df.index).where(~np.isnan(freqs))
+    return df
+
+
+def get_cachefile(tablefile, tipe=None):
+    """
+    Get the path to the binary sidecar cache for tablefile.
+    With tipe, get the path to the cached filter_data() output for tipe.
+    """
+    if tipe is not None:
+        return tablefile.replace(".txt", f"_{tipe}_filtered.pkl")
+    return tablefile.replace(".txt", ".pkl")
+
+
+def read_cache(tablefile, tipe=None, params=None):
+    """
+    Load the parsed (or with tipe, filtered) VariantsToTable output from its sidecar cache.
+
+    Positional arguments:
+    tablefile - path to VariantsToTable output
+
+    Keyword arguments:
+    tipe - str; load the filtered output for tipe instead of the parsed tablefile
+    params - dict; filter parameters that must match those used when cached (see get_filter_params())
+
+    Returns:
+    df - pandas.dataframe; None if there is no cache or tablefile/params changed since it was cached
+    """
+    cachefile = get_cachefile(tablefile, tipe)
+    if not op.exists(cachefile):
+        return None
+    try:
+        cache = pklload(cachefile)
+    except Exception:
+        # any unreadable cache (eg from an interrupted write or older pandas) is rebuilt
+        print(f'could not read {op.basename(cachefile)}, rebuilding cache')
+        return None
+    if cache['fingerprint'] != fingerprint(tablefile):
+        print(f'{op.basename(tablefile)} changed since it was cached, rebuilding cache')
+        return None
+    if cache.get('params') != params:
+        print(f'filter parameters changed since {op.basename(cachefile)} was cached, rebuilding cache')
+        return None
+    return cache['df']
+
+
+def write_cache(tablefile, df, tipe=None, params=None):
+    """
+    Save the parsed (or with tipe, filtered) VariantsToTable output next to tablefile so later loads skip work.
+    The cache is keyed by the size and mtime of tablefile (and params).
+    """
+    cachefile = get_cachefile(tablefile, tipe)
+    # write to a temporary file first so a partial cache is never read
+    tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+    try:
+        pkldump({'fingerprint': fingerprint(tablefile), 'params': params, 'df': df}, tmpfile)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        print(f'could not cache {op.basename(cachefile)}: {e}')
+        if op.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def get_filter_params(tablefile):
+    """
+    Get the parameters that filter_data() output depends on, used to key cached filter results.
+
+    Positional arguments:
+    tablefile - path to VariantsToTable output - used to find ploidy etc
+
+    Returns:
+    params - dict
+    """
+    lowfreq, highfreq, ploidy = get_freq_cutoffs(tablefile)
+    pooldir = op.dirname(op.dirname(tablefile))
+    npools = len(pklload(op.join(op.dirname(pooldir), 'poolsamps.pkl'))[op.basename(pooldir)])
+    return {'ploidy': ploidy, 'npools': npools, 'lowfreq': lowfreq, 'highfreq': highfreq,
+            'min_gq': MIN_GQ, 'max_missing': MAX_MISSING, 'freq_decimals': FREQ_DECIMALS,
+            'cache_version': CACHE_VERSION}
+
+
+def load_data(tablefile, cache=True):
     """
     Load the VariantsToTable output.
     
     Positional arguments:
     tablefile - path to VariantsToTable output - used to find ploidy etc
+
+    Keyword arguments:
+    cache - bool; load from (and create) the binary sidecar cache of tablefile
     
     Returns:
     df - pandas.dataframe; VariantsToTable output
@@ -348,94 +556,304 @@ def load_data(tablefile):
     """
     tf = op.basename(tablefile)
 
-    # load the data, create a column with CHROM-POS for locusID
-    df = pd.read_csv(tablefile, sep='\t')
+    params = {'cache_version': CACHE_VERSION}
+    df = read_cache(tablefile, params=params) if cache is True else None
+    if df is None:
+        # load the data, create a column with CHROM-POS for locusID
+        df = pd.read_csv(tablefile, sep='\t', dtype=get_dtypes(tablefile))
+        df = add_locus(parse_freqs(df))
+        if cache is True:
+            write_cache(tablefile, df, params=params)
+    else:
+        print(f'loaded {tf} from cache')
     print(f'{tf} has {len(df.index)} rows (includes multiallelic)')
-    df['locus'] = ["%s-%s" % (contig, pos) for (contig, pos) in zip(df['CHROM'].tolist(), df['POS'].tolist())]
     return df, tf
 
 
+def read_chunks(tablefile, chunksize):
+    """
+    Read the VariantsToTable output in chunks of about chunksize rows.
+    Chunks only break between loci (CHROM-POS) so multiallelic splits and REF=N pairs stay together.
+
+    Positional arguments:
+    tablefile - path to VariantsToTable output
+    chunksize - int; number of rows to read from tablefile at a time
+
+    Yields:
+    chunk - pandas.dataframe; VariantsToTable output for whole loci
+    """
+    leftover = None
+    for chunk in pd.read_csv(tablefile, sep='\t', dtype=get_dtypes(tablefile), chunksize=chunksize):
+        if len(chunk.index) == 0:
+            # header-only tablefile (eg from a small bedfile)
+            continue
+        chunk = parse_freqs(chunk)
+        if leftover is not None:
+            chunk = pd.concat([leftover, chunk])
+        # hold back the last locus, the rest of its rows may be in the next chunk
+        last = (chunk['CHROM'] == chunk['CHROM'].iloc[-1]) & (chunk['POS'] == chunk['POS'].iloc[-1])
+        leftover = chunk[last]
+        if not last.all():
+            yield chunk[~last]
+    if leftover is not None and len(leftover.index) > 0:
+        yield leftover
+
+
 def keep_snps(df, tf):
     """
     Count CHROM-POS (locus) and keep only those with one ALT.
     
     Positional arguments:
-    df - pandas.dataframe; currently filtered VariantsToTable output
+    df - pandas.dataframe; VariantsToTable output
     tf - basename of path to VariantsToTable output
 
     Returns:
-    df - pandas.dataframe; non-multiallelic-filtered VariantsToTable output
+    keep - boolean numpy.ndarray; True for non-multiallelic loci with REF != N
     """
-    loccount = table(df['locus'])
-    goodloci = [locus for locus in loccount if loccount[locus] == 1]
-    print(f'{tf} has {len(goodloci)} good loci (non-multiallelic)')
+    goodloci = ~df['locus'].duplicated(keep=False)
+    print(f'{tf} has {goodloci.sum()} good loci (non-multiallelic)')
 
     # filter df for multiallelic (multiple lines), REF != N
-    df = df[df['locus'].isin(goodloci)].copy()
-    df = df[df['REF'] != 'N'].copy()
-    return df
+    return (goodloci & (df['REF'] != 'N')).values
+
+
+def filter_type(df, tipe):
+    """Find loci called a tipe by program."""
+    return (df['TYPE'] == tipe).values
+
+
+def get_columns(df, ndfs, rows, cols):
+    """
+    Get cols for the loci that passed the row filters without subsetting all of df.
+
+    Positional arguments:
+    df - pandas.dataframe; VariantsToTable output
+    ndfs - pandas.dataframe; REF=N loci from get_refn_snps()
+    rows - numpy.ndarray; positions of rows in df that passed keep_snps() and filter_type()
+    cols - list of columns to get
+
+    Returns:
+    pandas.dataframe; cols of ndfs followed by cols of df at rows
+    """
+    return pd.concat([ndfs[cols], df[cols].take(rows)], ignore_index=True)
+
+
+def take_rows(df, ndfs, rows, keep):
+    """
+    Create the filtered dataframe, the only full copy of the rows that pass.
 
+    Positional arguments:
+    df - pandas.dataframe; VariantsToTable output
+    ndfs - pandas.dataframe; REF=N loci from get_refn_snps()
+    rows - numpy.ndarray; positions of rows in df that passed keep_snps() and filter_type()
+    keep - boolean numpy.ndarray; loci (ndfs followed by rows) that passed the rest of the filters
 
-def filter_type(df, tf, tipe):
-    """Keep onli loci called a SNP by program."""
-    df = df[df['TYPE'] == tipe].copy()
-    print(f'{tf} has {len(df.index)} good loci of the type {tipe}')
+    Returns:
+    df - pandas.dataframe; filtered VariantsToTable output
+    """
+    nkeep = keep[:len(ndfs.index)]
+    df = df.take(rows[keep[len(ndfs.index):]])
+    if len(ndfs.index) > 0:
+        df = pd.concat([ndfs[nkeep], df])
+    df.index = range(len(df.index))
     return df
 
 
-def main(tablefile, tipe, ret=False):
-    print('\nstarting filter_VariantsToTable.py for %s' % tablefile)
+def filter_data(df, tf, tipe, tablefile):
+    """
+    Filter VariantsToTable output for tipe.
+    Each filter returns a boolean mask, df is not modified and is only subset once at the end.
 
-    # load the data
-    df, tf = load_data(tablefile)
+    Positional arguments:
+    df - pandas.dataframe; VariantsToTable output from load_data() or read_chunks()
+    tf - basename of tablefile
+    tipe - str; one of either "SNP" or "INDEL"
+    tablefile - path to VariantsToTable output - used to find ploidy etc
 
-    # determine loci with REF=N but biallelic otherwise
+    Returns:
+    df - pandas.dataframe; filtered VariantsToTable output
+    """
     if tipe == 'SNP':
-        dfs, ndfs = get_refn_snps(df, tipe)
+        # determine loci with REF=N but biallelic otherwise
+        ndfs = profiler.run('get_refn_snps', get_refn_snps, df, tipe)
 
         # determine which loci are multiallelic
-        df = keep_snps(df, tf)
+        rowmask = profiler.run('keep_snps', keep_snps, df, tf)
+    else:
+        ndfs = df.iloc[0:0]
+        rowmask = np.ones(len(df.index), dtype=bool)
 
     # filter for tipe, announce num after initial filtering
-    df = filter_type(df, tf, tipe)
+    rowmask = rowmask & profiler.run('filter_type', filter_type, df, tipe)
+    rows = np.flatnonzero(rowmask)
+    print(f'{tf} has {len(rows)} good loci of the type {tipe}')
 
-    if len(df.index) == 0:
-        if ret is True:
-            return df
-        else:
-            # save
-            write_file(tablefile, df, tipe)
-
-    # add in loci with REF=N but biallelic otherwise
-    if tipe == 'SNP' and len(dfs) > 0:
+    # loci with REF=N but biallelic otherwise go first
+    if len(ndfs.index) > 0:
         print(f'{tf} has {len(ndfs.index)} biallelic {tipe}s with REF=N')
-        dfs.append(df)
-        df = pd.concat(dfs)
+    keep = np.ones(len(ndfs.index) + len(rows), dtype=bool)
 
     # filter for quality and missing data
-    df.index = range(len(df.index))
-    if 'varscan' in tf and tipe == 'SNP':
+    if len(keep) > 0 and 'varscan' in tf and tipe == 'SNP':
         # if we allow to continue for INDEL, each line is treated as a locus (not true for INDEL)
-        df = filter_qual(df, tf, tipe, tablefile)
-    if 'crisp' in tf:
-        df = add_freq_cols(df, tf, tipe, tablefile)
+        qualcols = [col for col in df.columns if '.GQ' in col or '.FREQ' in col]
+        keep, badqual, globfreqs = filter_qual(get_columns(df, ndfs, rows, qualcols), tf, tipe, tablefile)
+        df = profiler.run('take_rows', take_rows, df, ndfs, rows, keep)
+        # mask freqs that have GQ < 20
+        for i, freqcol in enumerate([col for col in qualcols if '.FREQ' in col]):
+            bad = badqual[i, keep]
+            if bad.any():
+                df.loc[bad, freqcol] = np.nan
+        if globfreqs is not None:
+            df['AF'] = globfreqs[keep]
+    elif 'crisp' in tf:
+        # run even without loci so every crisp output has the same columns
+        gtcols = [col for col in df.columns if '.GT' in col]
+        data = get_columns(df, ndfs, rows, ['REF', 'ALT', 'AF'] + gtcols)
+        freqs = profiler.run('get_pool_freqs', get_pool_freqs, data)
+        afs = recalc_global_freq(freqs, data['AF'].values)
         print('filtering for missing data ...')
-        df = filter_missing_data(df, tf, tipe)
-        print(f'{tf} has {len(df.index)} loci with < 25% missing data')
-        lowfreq, highfreq = get_freq_cutoffs(tablefile)
-        df = df[(df['AF'] <= highfreq) & (df['AF'] >= lowfreq)].copy()
-        print(f'{tf} has {len(df.index)} loci with MAF > {lowfreq}')
-        df.index = range(len(df.index))
+        keep = profiler.run('filter_missing_data', filter_missing_data, freqs)
+        print(f'{tf} has {keep.sum()} loci with < {MAX_MISSING:.0%} missing data')
+        keep = profiler.run('filter_freq', filter_af, afs, tablefile, keep)
+        df = profiler.run('take_rows', take_rows, df, ndfs, rows, keep)
+        df = profiler.run('add_freq_cols', add_freq_cols, df, tf, freqs[:, keep], afs[keep])
+    else:
+        df = profiler.run('take_rows', take_rows, df, ndfs, rows, keep)
 
-    
+    return profiler.run('format_output', format_output, df, tf)
+
+
+def filter_chunks(tablefile, tipe, chunksize, ret=False):
+    """
+    Stream tablefile through filter_data() so peak memory depends on chunksize, not file size.
+    Each filtered chunk is appended to the output file as soon as it is ready.
+
+    Positional arguments:
+    tablefile - path to VariantsToTable output
+    tipe - str; one of either "SNP" or "INDEL"
+    chunksize - int; number of rows to read from tablefile at a time
+
+    Keyword arguments:
+    ret - bool; return filtered chunks as one pandas.dataframe instead of writing to file
+    """
+    tf = op.basename(tablefile)
+    newfile = tablefile.replace(".txt", f"_{tipe}.txt")
+    dfs = []
+    i = -1
+    for i, chunk in enumerate(read_chunks(tablefile, chunksize)):
+        profiler.context['chunk'] = i
+        print(f'{tf} chunk {i} has {len(chunk.index)} rows (includes multiallelic)')
+        df = filter_data(profiler.run('add_locus', add_locus, chunk), tf, tipe, tablefile)
+        if ret is True:
+            dfs.append(df)
+        else:
+            # write the header with the first chunk only
+            profiler.run('write_file', df.to_csv, newfile, index=False, sep='\t',
+                         mode='w' if i == 0 else 'a', header=i == 0)
+            profiler.annotate(rows_in=len(df.index))
+    profiler.context = {}
+    if i == -1:
+        # no rows in tablefile, filter the empty table so the output has the same header as main() without chunks
+        df = filter_data(add_locus(parse_freqs(pd.read_csv(tablefile, sep='\t', dtype=get_dtypes(tablefile)))),
+                         tf, tipe, tablefile)
+        if ret is True:
+            return df
+        profiler.run('write_file', df.to_csv, newfile, index=False, sep='\t')
     if ret is True:
-        return df
+        return pd.concat(dfs)
+    print('finished filtering VariantsToTable file: %s' % newfile)
+
+
+def filter_types(tablefile, tipes, cache=True):
+    """
+    Load tablefile once and filter it for each tipe.
+    filter_data() does not modify the loaded dataframe, so each tipe filters the same data.
+
+    Positional arguments:
+    tablefile - path to VariantsToTable output
+    tipes - list of tipe (eg ['SNP', 'INDEL'])
+
+    Keyword arguments:
+    cache - bool; reuse (and save) filtered output for each tipe, tablefile is only
+        re-filtered if it or the filter parameters changed since the output was cached,
+        and then loaded from its parsed cache (see load_data()) if only the filter parameters changed
+
+    Returns:
+    dfs - dict with key = tipe, val = pandas.dataframe; filtered VariantsToTable output
+    """
+    print('\nstarting filter_VariantsToTable.py for %s' % tablefile)
+    profiler.reset()
+    tf = op.basename(tablefile)
+
+    dfs = {}
+    params = get_filter_params(tablefile)
+    if cache is True:
+        for tipe in tipes:
+            df = profiler.run('read_cache', read_cache, tablefile, tipe=tipe, params=params)
+            if df is not None:
+                print(f'loaded filtered {tipe}s for {tf} from cache')
+                dfs[tipe] = df
+
+    todo = [tipe for tipe in tipes if tipe not in dfs]
+    if len(todo) > 0:
+        # the parsed table is cached too, so re-filtering with new parameters (eg thresholds) skips parsing
+        df, tf = profiler.run('load_data', load_data, tablefile, cache)
+        for tipe in todo:
+            profiler.context['tipe'] = tipe
+            dfs[tipe] = filter_data(df, tf, tipe, tablefile)
+            if cache is True:
+                profiler.run('write_cache', write_cache, tablefile, dfs[tipe], tipe=tipe, params=params)
+        profiler.context = {}
+    return dict((tipe, dfs[tipe]) for tipe in tipes)
+
+
+def main(tablefile, tipe, ret=False, chunksize=None):
+    if ',' in tipe:
+        tipes = tipe.split(',')
+        if chunksize is not None:
+            # stream tablefile for each tipe
+            dfs = dict((tipe, main(tablefile, tipe, ret=ret, chunksize=chunksize)) for tipe in tipes)
+            return dfs if ret is True else None
+        # load once and filter for each tipe (eg in each bedfile job of start_crispANDvarscan.py)
+        dfs = filter_types(tablefile, tipes)
+        if ret is True:
+            return dfs
+        for tipe, df in dfs.items():
+            profiler.context['tipe'] = tipe
+            profiler.run('write_file', write_file, tablefile, df, tipe)
+            profiler.annotate(rows_in=len(df.index))
+        profiler.context = {}
+        profiler.dump(tablefile.replace('.txt', f"_{'_'.join(tipes)}_profile.json"),
+                      tablefile=tablefile, tipes=tipes)
+        return
+
+    print('\nstarting filter_VariantsToTable.py for %s' % tablefile)
+    profiler.reset()
+
+    if chunksize is not None:
+        # stream tables that are too big to filter in memory
+        df = filter_chunks(tablefile, tipe, chunksize, ret=ret)
     else:
-        # save
-        write_file(tablefile, df, tipe)
+        # load the data
+        df, tf = profiler.run('load_data', load_data, tablefile)
+
+        # filter for tipe, quality, missing data, and freq
+        df = filter_data(df, tf, tipe, tablefile)
+
+        if ret is False:
+            # save
+            profiler.run('write_file', write_file, tablefile, df, tipe)
+            profiler.annotate(rows_in=len(df.index))
+
+    if ret is True:
+        # caller (eg combine_crispORvarscan.py) collects profiler.records
+        return df
+    profiler.dump(tablefile.replace('.txt', f'_{tipe}_profile.json'),
+                  tablefile=tablefile, tipe=tipe, chunksize=chunksize)
 
 
 if __name__ == '__main__':
-    thisfile, tablefile, tipe = sys.argv
+    thisfile, tablefile, tipe, *chunksize = sys.argv
 
-    main(tablefile, tipe)
+    main(tablefile, tipe, chunksize=int(chunksize[0]) if len(chunksize) > 0 else None)
@@ -6,7 +6,15 @@ If multiple samps per pool_name:
     - set min freq to 1/(ploidy_per_samp * nsamps)
 
 # usage
-# python start_crispANDvarscan.py parentdir pool
+# python start_crispANDvarscan.py parentdir pool [samp [mapfilter [throttle]]]
+# (samp - sample whose IndelRealigner job finished, recorded before checking if all samps of pool are done;
+#  None to only check (eg when rerunning by hand))
+# (mapfilter - True (default) to filter each table in its bedfile job, combine then only merges;
+#  False to leave all filtering to combine_crispORvarscan.py)
+# (throttle - max number of bedfile tasks of the job array running at once, default ARRAY_THROTTLE;
+#  0 to sbatch one job per bedfile instead of one job array)
+# (with more than COMBINE_GROUPSIZE bedfiles, groups of bedfiles are combined by group jobs as their
+#  bedfile jobs finish, and a small final job merges the group files)
 #
 
 # fix
@@ -15,39 +23,49 @@ If multiple samps per pool_name:
 """
 
 
-import sys, os, time, random, subprocess, balance_queue, shutil
+import sys, os, time, math, subprocess, balance_queue, shutil, create_bedfiles
 from os import path as op
-from datetime import datetime as dt
 from coadaptree import makedir, fs, pklload, get_email_info
-from balance_queue import getsq
-
-
-def gettimestamp(f):
-    """Get last time modified."""
-    return time.ctime(op.getmtime(f))
-
-
-def getmostrecent(files):
-    """Determine the most recent file from a list of files."""
-    if not isinstance(files, list):
-        files = [files]
-    if len(files) > 1:
-        whichout = files[0]
-        dt1 = dt.strptime(gettimestamp(whichout)[4:], "%b %d %H:%M:%S %Y")
-        for o in files[1:]:
-            dt2 = dt.strptime(gettimestamp(o)[4:], "%b %d %H:%M:%S %Y")
-            if dt2 > dt1:
-                whichout = o
-                dt1 = dt2
-        return whichout
-    elif len(files) == 1:
-        return files[0]
-    else:
-        # if len(files) == 0
-        return None
 
 
-def getfiles(samps, shdir, grep):
+# programs to call variants with, with both programs one job per bedfile runs both (see make_sh)
+#PROGRAMS = ['crisp', 'varscan']  # I'll be deprecating crisp soon
+PROGRAMS = ['varscan']
+
+# max number of bedfiles combined by each group job (see create_combine)
+COMBINE_GROUPSIZE = 25
+
+# max number of bedfile tasks of the job array running at once (see create_array)
+ARRAY_THROTTLE = 100
+
+# number of sacct calls before giving up on jobs that are missing from accounting (see sacct)
+SACCT_RETRIES = 5
+
+# MB needed to filter one bedfile's table in the calling job (see get_program_cmds)
+FILTER_MEM = 4000
+
+
+def index_shdir(shdir):
+    """Index the .sh and .out files in shdir with a single os.scandir pass.
+
+    Returns:
+    shfiles - sorted list of paths to .sh files
+    outs - dictionary where key = job name (outfile name without _{jobid}.out), val = most recent outfile
+    """
+    shfiles, outs, mtimes = [], {}, {}
+    with os.scandir(shdir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.sh'):
+                shfiles.append(entry.path)
+            elif entry.name.endswith('.out') and '_' in entry.name:
+                jobname = entry.name.rsplit('_', 1)[0]
+                mtime = entry.stat().st_mtime
+                if jobname not in outs or mtime > mtimes[jobname]:
+                    outs[jobname], mtimes[jobname] = entry.path, mtime
+    return sorted(shfiles), outs
+
+
+def getfiles(samps, shdir, grep, index=None):
     """Determine if all realign bam jobs have been created and sbatched.
 
     Positional arguments:
@@ -55,69 +73,132 @@ def getfiles(samps, shdir, grep):
     shdir - directory where .sh and .out files are
     grep - program name - keyword used to find correct files
 
+    Keyword arguments:
+    index - (shfiles, outs) from index_shdir(shdir), to reuse for several calls
+
     Returns:
     files - dictionary where key = sh file, val = most recent outfile
     """
-    found = [sh for sh in fs(shdir) if sh.endswith(".sh") and grep in sh]
-    outs = [out for out in fs(shdir) if out.endswith('.out') and grep in out]
+    shfiles, outs = index_shdir(shdir) if index is None else index
+    found = [sh for sh in shfiles if grep in sh]
     if len(found) != len(samps):
         print('not all shfiles have been created, exiting %s' % sys.argv[0])
         exit()
-    files = dict((f, getmostrecent([out for out in outs if op.basename(f).replace(".sh", "") in out]))
-                 for f in found)
+    files = dict((f, outs.get(op.basename(f).replace(".sh", ""))) for f in found)
     if None in files.values():
         print('not all shfiles have been sbatched, exiting %s' % sys.argv[0])
         exit()
     return files
 
 
-def check_seff(outs):
-    """Execute slurm seff command on each outfile's slurm_job_id to ensure it ran without error.
+def getarrayfiles(nums, shdir, grep, index=None):
+    """Determine if the job array tasks for bedfile nums have been sbatched (see create_array()).
+
+    Positional arguments:
+    nums - list of bedfile numbers (eg '0001')
+    shdir - directory where .sh and .out files are
+    grep - job name of the array, eg {pool}-{program}_bedfile
+
+    Keyword arguments:
+    index - (shfiles, outs) from index_shdir(shdir), to reuse for several calls
+
+    Returns:
+    files - dictionary where key = task job name (eg {pool}-{program}_bedfile_0001), val = most recent outfile
+    """
+    shfiles, outs = index_shdir(shdir) if index is None else index
+    files = dict((f'{grep}_{num}', outs.get(f'{grep}_{num}')) for num in nums)
+    if None in files.values():
+        print('not all array tasks have started, exiting %s' % sys.argv[0])
+        exit()
+    return files
+
+
+def get_pid(outfile):
+    """Get the slurm job id from an outfile named {jobname}_{jobid}.out."""
+    return op.basename(outfile).split("_")[-1].replace(".out", "")
+
+
+def sacct(pids):
+    """Get the state and exit code of each job in pids with one batched sacct call.
+    Retry (up to SACCT_RETRIES times) if sacct fails or accounting doesn't have all of the jobs yet.
+
+    Returns:
+    states - dictionary where key = pid, val = (state, exitcode) eg ('COMPLETED', '0:0')
+    """
+    states = {}
+    cmd = [shutil.which('sacct'), '-j', ','.join(pids), '-n', '-P', '-o', 'JobID,State,ExitCode', '-X']
+    for attempt in range(SACCT_RETRIES):
+        try:
+            lines = subprocess.check_output(cmd).decode('utf-8').split('\n')
+        except subprocess.CalledProcessError:
+            lines = []
+        for line in lines:
+            if line.count('|') == 2:
+                jobid, state, exitcode = line.split('|')
+                states[jobid] = (state, exitcode)
+        if all(pid in states for pid in pids):
+            return states
+        # sometimes slurm sucks
+        time.sleep(attempt + 1)
+    missing = [pid for pid in pids if pid not in states]
+    print('sacct could not find jobs: %s' % ','.join(missing))
+    print('slurm is screwing something up with sacct, exiting %s' % sys.argv[0])
+    exit()
+
+
+def check_sacct(outs, pids=None):
+    """Use one batched sacct call to ensure each outfile's slurm_job_id ran without error.
     Exit otherwise.
+
+    Keyword arguments:
+    pids - list of job ids in the same order as outs, default from the outfile names
+           (eg arrayid_task for job array tasks)
     """
-    print('checking seff')
-    jobid = os.environ['SLURM_JOB_ID']
-    for f in outs:
-        pid = f.split("_")[-1].replace(".out", "")
-        if not pid == jobid:
-            seff, seffcount = '', 0
-            while isinstance(seff, list) is False:
-                # sometimes slurm sucks
-                seff = subprocess.check_output([shutil.which('seff'), pid]).decode('utf-8').split('\n')
-                if seffcount == 10:
-                    print('slurm is screwing something up with seff, exiting %s' % sys.argv[0])
-                    exit()
-                time.sleep(1)
-                seffcount += 1
-            state = [x.lower() for x in seff if 'State' in x][0]
-            if 'exit code 0' not in state:
-                status = 'died' if 'running' not in state else 'is running'
-                print('cannot proceed with %s' % sys.argv[0])
-                print('job %s (%s) for %s' % (status, state, f))
-                print('exiting %s' % sys.argv[0])
-                exit()
-
-
-def checkpids(outs, queue):
-    """If any of the other crisp jobs are pending or running, exit."""
-    print('checking pids')
-    pids = [q[0] for q in queue]
-    jobid = os.environ['SLURM_JOB_ID']
-    for out in outs:
-        pid = out.split("_")[-1].replace(".out", "")
-        if pid in pids and pid != jobid:  # if the job is running, but it's not this job
-            print('the following file is still in the queue - exiting %s' % sys.argv[0],
-                  '\n', '\t%(out)s' % locals())
+    print('checking sacct')
+    outs = list(outs)
+    pids = [get_pid(f) for f in outs] if pids is None else list(pids)
+    jobid = os.environ.get('SLURM_JOB_ID')
+    jobs = dict((pid, f) for pid, f in zip(pids, outs) if pid != jobid)
+    if len(jobs) == 0:
+        return
+    states = sacct(list(jobs.keys()))
+    for pid, f in jobs.items():
+        state, exitcode = states[pid]
+        if not (state == 'COMPLETED' and exitcode == '0:0'):
+            status = 'died' if state not in ['PENDING', 'RUNNING', 'REQUEUED'] else 'is running'
+            print('cannot proceed with %s' % sys.argv[0])
+            print('job %s (%s, exit code %s) for %s' % (status, state.lower(), exitcode, f))
+            print('exiting %s' % sys.argv[0])
             exit()
 
 
-def check_queue(outs, pooldir):
-    """Get jobs from the queue, except those that are closing (assumes jobs haven't failed)."""
-    print('checking queue')
-    sq = getsq(grepping=['crisp_bedfile', op.basename(pooldir)])
-    if len(sq) > 0:
-        checkpids(outs, sq)
-    # no need for an else statement here, if len(sq) == 0: no need to check the pids
+def get_donedir(pooldir):
+    """Get the directory where finished IndelRealigner jobs are recorded (see record_done())."""
+    return makedir(op.join(pooldir, 'shfiles/05_indelRealign_done'))
+
+
+def record_done(pooldir, samp):
+    """Atomically record that the realigned bamfile for samp has been created."""
+    print(f'recording that {samp} is done')
+    file = op.join(get_donedir(pooldir), f'{samp}.done')
+    try:
+        # O_EXCL - a requeued or rerun job doesn't overwrite the first record
+        fd = os.open(file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, 'w') as o:
+        o.write("%s" % os.environ.get('SLURM_JOB_ID', ''))
+
+
+def check_done(samps, pooldir):
+    """If any of samps have not been recorded as done, exit."""
+    print('checking done')
+    with os.scandir(get_donedir(pooldir)) as entries:
+        done = [entry.name.replace('.done', '') for entry in entries if entry.name.endswith('.done')]
+    missing = [samp for samp in samps if samp not in done]
+    if len(missing) > 0:
+        print(f'waiting on {len(missing)} of {len(samps)} samps to be realigned, exiting %s' % sys.argv[0])
+        exit()
 
 
 def get_bamfiles(samps, pooldir):
@@ -143,31 +224,24 @@ def checkfiles(pooldir):
     print('checking files')
     pool = op.basename(pooldir)
     samps = pklload(op.join(op.dirname(pooldir), 'poolsamps.pkl'))[pool]
-    shdir = op.join(pooldir, 'shfiles/05_indelRealign_shfiles')
-    files = getfiles(samps, shdir, 'indelRealign')
-    check_queue(files.values(), pooldir)  # make sure job isn't in the queue (running or pending)
-    check_seff(files.values())  # make sure the jobs didn't die
+    check_done(samps, pooldir)  # make sure every IndelRealigner job finished without error
     return get_bamfiles(samps, pooldir)
 
 
-def create_reservation(pooldir, exitneeded=False):
+def create_reservation(pooldir):
     """Create a file so that other realign jobs can't start crisp and varscan too."""
     print('creating reservation')
+    pool = op.basename(pooldir)
     shdir = makedir(op.join(pooldir, 'shfiles/crispANDvarscan'))
     file = op.join(shdir, '%s_crispANDvarscan_reservation.sh' % pool)
-    jobid = os.environ['SLURM_JOB_ID']
-    if not op.exists(file):
-        with open(file, 'w') as o:
-            o.write("%s" % jobid)
-    else:
-        exitneeded = True
-    time.sleep(random.random()*15)
-    with open(file, 'r') as o:
-        fjobid = o.read().split()[0]
-    if not fjobid == jobid or exitneeded is True:
-        # just in case two jobs try at nearly the same time
+    try:
+        # O_EXCL - only one of the jobs that see all samps done (eg at nearly the same time) creates the file
+        fd = os.open(file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
         print('another job has already created crispANDvarscan_reservation.sh for %s' % pool)
         exit()
+    with os.fdopen(fd, 'w') as o:
+        o.write("%s" % os.environ.get('SLURM_JOB_ID', ''))
     return shdir
 
 
@@ -181,21 +255,32 @@ def get_prereqs(bedfile, pooldir, parentdir, pool, program):
 
 
 def get_small_bam_cmds(bamfiles, bednum, bedfile):
-    """Get samtools commands to reduce a bamfile to intervals in the bedfile."""
+    """Get samtools commands to reduce a bamfile to intervals in the bedfile.
+
+    -M uses the bam index (.bai) to read only the blocks that overlap the intervals,
+    -L alone reads through the entire bamfile.
+    """
     smallbams = []
     cmds = '''module load java\nmodule load samtools/1.9\n'''
     for bam in bamfiles:
         pool = op.basename(bam).split("_realigned")[0]
         smallbam = f'$SLURM_TMPDIR/{pool}_realigned_{bednum}.bam'
-        cmd = f'''samtools view -b -L {bedfile} {bam} > {smallbam}\n'''
+        cmd = f'''samtools view -b -M -L {bedfile} {bam} > {smallbam}\n'''
         cmds = cmds + cmd
         smallbams.append(smallbam)
     return (smallbams, cmds)
 
 
-def get_crisp_cmd(bamfiles, bedfile, pool, parentdir, ref, vcf, bednum):
-    """Create command to call crisp."""
-    smallbams, smallcmds = get_small_bam_cmds(bamfiles, bednum, bedfile)
+def get_crisp_cmd(bamfiles, bedfile, pool, parentdir, ref, vcf, bednum, smallbams=None):
+    """Create command to call crisp.
+
+    Keyword arguments:
+    smallbams - list of bam slices already created by the job (see make_sh()), default slice bamfiles here
+    """
+    if smallbams is None:
+        smallbams, smallcmds = get_small_bam_cmds(bamfiles, bednum, bedfile)
+    else:
+        smallcmds = ''
     bams = ' --bam '.join(smallbams)
     poolsize = pklload(op.join(parentdir, 'ploidy.pkl'))[pool]
     logfile = vcf.replace(".vcf", ".log")
@@ -213,9 +298,17 @@ module unload python
     return (cmds, convertfile, logfile)
 
 
-def get_varscan_cmd(bamfiles, bedfile, bednum, vcf, ref):
-    """Create command to call varscan."""
-    smallbams, smallcmds = get_small_bam_cmds(bamfiles, bednum, bedfile)
+def get_varscan_cmd(bamfiles, bedfile, bednum, vcf, ref, smallbams=None):
+    """Create command to call varscan.
+
+    Keyword arguments:
+    smallbams - list of bam slices already created by the job (see make_sh()), default slice bamfiles here
+    """
+    if smallbams is None:
+        smallbams, smallcmds = get_small_bam_cmds(bamfiles, bednum, bedfile)
+    else:
+        # modules may have been changed by the program run before varscan
+        smallcmds = '''module load java\nmodule load samtools/1.9\n'''
     smallbams = ' '.join(smallbams)
     ploidy = pklload(op.join(parentdir, 'ploidy.pkl'))[pool]
     # if single-sample then set minfreq to 0, else use min possible allele freq
@@ -225,7 +318,8 @@ def get_varscan_cmd(bamfiles, bedfile, bednum, vcf, ref):
     tool = 'mpileup2cns'
     # --strand-filter not mentioned in docs for pileup2cns
     strand_filter = '' if tool == 'pileup2cns' else '--strand-filter 1'
-    cmd = f'''samtools mpileup -B -f {ref} {smallbams} | java -Xmx15g -jar \
+    # -l so that reads overlapping the edge of a split contig (see create_bedfiles.py) are only called once
+    cmd = f'''samtools mpileup -B -f {ref} -l {bedfile} {smallbams} | java -Xmx15g -jar \
 $VARSCAN_DIR/VarScan.v2.4.3.jar {tool} --min-coverage 8 --p-value 0.05 \
 --min-var-freq {minfreq} {strand_filter} --min-freq-for-hom 0.80 \
 --min-avg-qual 20 --output-vcf 1 > {vcf}
@@ -234,8 +328,18 @@ module unload samtools'''
     return (cmds, vcf)
 
 
-def make_sh(bamfiles, bedfile, shdir, pool, pooldir, program):
-    """Create sh file for varscan or crisp command."""
+def get_program_cmds(bamfiles, bedfile, pooldir, pool, program, mapfilter=True, smallbams=None):
+    """Create the commands for one program (crisp or varscan) of a bedfile job - call, vcf -> table, filter.
+
+    Keyword arguments:
+    mapfilter - bool; filter SNPs and INDELs from the table in this job instead of in the combine job
+    smallbams - list of bam slices already created by the job, default the program slices bamfiles itself
+
+    Returns:
+    text - commands for the .sh file
+    mem - int; MB needed by program
+    days - int; time needed by program
+    """
     num, ref, vcf = get_prereqs(bedfile, pooldir, parentdir, pool, program)
     if program == 'crisp':
         cmd, finalvcf, logfile = get_crisp_cmd(bamfiles,
@@ -244,31 +348,33 @@ def make_sh(bamfiles, bedfile, shdir, pool, pooldir, program):
                                                parentdir,
                                                ref,
                                                vcf,
-                                               num)
+                                               num,
+                                               smallbams)
         second_cmd = f'''gzip {vcf}
 rm {logfile}
 '''
-        mem = "9000M"
-        time = '2-00:00:00'
+        mem = 9000
+        days = 2
         fields = '''-F DP -F CT -F AC -F VT -F EMstats -F HWEstats -F VF -F VP \
 -F HP -F MQS -GF GT -GF GQ -GF DP'''
     else:
-        cmd, finalvcf = get_varscan_cmd(bamfiles, bedfile, num, vcf, ref)
+        cmd, finalvcf = get_varscan_cmd(bamfiles, bedfile, num, vcf, ref, smallbams)
         second_cmd = ''''''
-        mem = "2000M"
-        time = '1-00:00:00'
+        mem = 2000
+        days = 1
         fields = '''-F ADP -F WT -F HET -F HOM -F NC -GF GT -GF GQ -GF SDP -GF DP \
 -GF FREQ -GF PVAL -GF AD'''
 
     tablefile = finalvcf.replace(".vcf", "_table.txt")
-    text = f'''#!/bin/bash
-#SBATCH --ntasks=1
-#SBATCH --job-name={pool}-{program}_bedfile_{num}
-#SBATCH --time={time}
-#SBATCH --mem={mem}
-#SBATCH --output={pool}-{program}_bedfile_{num}_%j.out
-
-# run CRISP (commit 60966e7) or VarScan (v.2.4.2)
+    # filtered results are cached next to tablefile, combine_crispORvarscan.py loads them instead of filtering
+    # a failed filter must not fail the job (and hold the combine job), combine filters any table without a cache
+    filter_cmd = f'''
+# filter SNPs and INDELs (so combine only has to merge)
+python $HOME/pipeline/filter_VariantsToTable.py {tablefile} SNP,INDEL || true
+''' if mapfilter is True else ''
+    if mapfilter is True:
+        mem = max(mem, FILTER_MEM)
+    text = f'''# run CRISP (commit 60966e7) or VarScan (v.2.4.2)
 {cmd}
 
 # vcf -> table (multiallelic to multiple lines, filtered in combine_crispORlofreq.py
@@ -282,13 +388,59 @@ cd $(dirname {finalvcf})
 gzip {finalvcf}
 {second_cmd}
 
-# if any other crisp jobs are hanging due to priority, change the account
 source $HOME/.bashrc
 export PYTHONPATH="${{PYTHONPATH}}:$HOME/pipeline"
+{filter_cmd}'''
+    return text, mem, days
+
+
+def make_sh(bamfiles, bedfile, shdir, pool, pooldir, program, mapfilter=True, array=None):
+    """Create sh file for varscan or crisp command.
+
+    Positional arguments:
+    program - str; crisp, varscan, or crispANDvarscan to run both programs in one job on the same bam slices
+
+    Keyword arguments:
+    mapfilter - bool; filter SNPs and INDELs from the table in this job instead of in the combine job
+    array - str; --array value (see get_array()) to create a job array template instead,
+            bedfile is then a template with ${num} in place of the bedfile number (see create_array())
+    """
+    num = bedfile.split("_")[-1].split(".bed")[0]
+    if program == 'crispANDvarscan':
+        # slice each bam once, both programs read the slices
+        smallbams, smallcmds = get_small_bam_cmds(bamfiles, num, bedfile)
+        programs = ['crisp', 'varscan']
+    else:
+        smallbams, smallcmds = None, ''
+        programs = [program]
+    cmds, mems, days = zip(*[get_program_cmds(bamfiles, bedfile, pooldir, pool, p, mapfilter, smallbams)
+                             for p in programs])
+    cmds = '\n'.join(cmds)
+    mem = f'{max(mems)}M'
+    time = f'{sum(days)}-00:00:00'
+    if array is None:
+        jobname = f'{pool}-{program}_bedfile_{num}'
+        header = f'#SBATCH --output={jobname}_%j.out\n'
+    else:
+        # each task selects its bedfile (and output names) from its array index
+        jobname = f'{pool}-{program}_bedfile'
+        header = f'''#SBATCH --output={jobname}_%4a_%A.out
+#SBATCH --array={array}
+
+num=$(printf "%04d" $SLURM_ARRAY_TASK_ID)
+'''
+    text = f'''#!/bin/bash
+#SBATCH --ntasks=1
+#SBATCH --job-name={jobname}
+#SBATCH --time={time}
+#SBATCH --mem={mem}
+{header}
+{smallcmds}{cmds}
+# if any other crisp jobs are hanging due to priority, change the account
 python $HOME/pipeline/balance_queue.py {program}
 
 '''
-    file = op.join(shdir, f'{pool}-{program}_bedfile_{num}.sh')
+    file = op.join(shdir, f'{jobname}.sh' if array is None else f'{jobname}_array.sh')
     with open(file, 'w') as o:
         o.write("%s" % text)
     return file
@@ -304,18 +456,25 @@ def sbatch(file):
 
 
 def get_bedfiles(parentdir, pool):
-    """Get a list of paths to all of the bed files for ref.fa."""
+    """Get a list of paths to all of the bed files for ref.fa.
+    Bedfiles balanced by the pool's reads (see create_bedfiles.make_pool_bedfiles) are used if they exist.
+    """
     ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
-    beddir = op.join(op.dirname(ref), 'bedfiles_%s' % op.basename(ref).split(".fa")[0])
+    bname = 'bedfiles_%s' % op.basename(ref).split(".fa")[0]
+    pooldir = op.join(parentdir, pool)
+    if op.exists(op.join(pooldir, bname)):
+        beddir = op.join(pooldir, bname)
+    else:
+        beddir = op.join(op.dirname(ref), bname)
     return [f for f in fs(beddir) if f.endswith('.bed')]
 
 
-def create_sh(bamfiles, shdir, pool, pooldir, program):
+def create_sh(bamfiles, shdir, pool, pooldir, program, mapfilter=True):
     """Create and sbatch shfiles, record pid to use as dependency for combine job."""
     bedfiles = get_bedfiles(parentdir, pool)
     pids = []
     for bedfile in bedfiles:
-        file = make_sh(bamfiles, bedfile, shdir, pool, pooldir, program)
+        file = make_sh(bamfiles, bedfile, shdir, pool, pooldir, program, mapfilter)
         # only use in case of emergencies:
         #outs = [out for out in fs(op.dirname(file)) if op.basename(file).replace('.sh', '') in out and out.endswith('.out')]
         #print('len outs = ', len(outs))
@@ -325,22 +484,31 @@ def create_sh(bamfiles, shdir, pool, pooldir, program):
     return pids
 
 
-def create_combine(pids, parentdir, pool, program, shdir):
-    """Create command file to combine crisp or varscan jobs once they're finished.
+def get_groups(items, ngroups):
+    """Split items into ngroups contiguous groups of (nearly) equal size.
 
-    Positional arguments:
-    pids = list of slurm job id dependencies (the jobs that need to finish first)
-    ...
+    Used for both the bedfile job pids (create_combine) and the bedfiles (combine_crispORvarscan.py),
+    so both need to be in get_bedfiles() order.
     """
-    pooldir = op.join(parentdir, pool)
-    email_text = get_email_info(parentdir, 'final')
+    items = list(items)
+    size, extra = divmod(len(items), ngroups)
+    groups, start = [], 0
+    for group in range(ngroups):
+        end = start + size + (1 if group < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def write_combine(shdir, name, pids, cmd, cpus, mem, time, email_text=''):
+    """Write a combine .sh file that waits for pids to finish ok, sbatch it and return its pid."""
     dependencies = '#SBATCH --dependency=afterok:' + ','.join(pids)
     text = f'''#!/bin/bash
-#SBATCH --job-name={pool}-combine-{program}
-#SBATCH --time=12:00:00
-#SBATCH --mem=20000M
-#SBATCH --cpus-per-task=1
-#SBATCH --output={pool}-combine-{program}_%j.out
+#SBATCH --job-name={name}
+#SBATCH --time={time}
+#SBATCH --mem={mem}
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --output={name}_%j.out
 {dependencies}
 {email_text}
 
@@ -349,42 +517,129 @@ source $HOME/.bashrc
 export PYTHONPATH="${{PYTHONPATH}}:$HOME/pipeline"
 export SQUEUE_FORMAT="%.8i %.8u %.12a %.68j %.3t %16S %.10L %.5D %.4C %.6b %.7m %N (%r)"
 
-python $HOME/pipeline/combine_crispORvarscan.py {pooldir} {program} {pool}
+{cmd}
 
 '''
-    combfile = op.join(shdir, f'{pool}-combine-{program}.sh')
+    combfile = op.join(shdir, f'{name}.sh')
     with open(combfile, 'w') as o:
         o.write("%s" % text)
-    sbatch(combfile)
-    print(f'sbatched {program} combinefile with dependencies: ' + ','.join(pids))
+    pid = sbatch(combfile)
+    print(f'sbatched {name} with dependencies: ' + ','.join(pids))
+    return pid
+
+
+def get_array(nums, throttle):
+    """Get the sbatch --array value for bedfile nums, eg ['0000', ..., '0449'] -> '0-449%100'."""
+    ints = sorted(int(num) for num in nums)
+    ranges, start = [], ints[0]
+    for previous, i in zip(ints, ints[1:] + [None]):
+        if i != previous + 1:
+            ranges.append(str(start) if start == previous else f'{start}-{previous}')
+            start = i
+    return ','.join(ranges) + f'%{throttle}'
+
+
+def create_array(bamfiles, shdir, pool, pooldir, program, mapfilter=True, throttle=ARRAY_THROTTLE):
+    """Create and sbatch one job array with a task for each bedfile.
+
+    Returns:
+    arrayid - slurm job id of the job array
+    pids - list of arrayid_task ids, one for each bedfile (in get_bedfiles() order)
+    """
+    bedfiles = get_bedfiles(parentdir, pool)
+    nums = [bedfile.split("_")[-1].split(".bed")[0] for bedfile in bedfiles]
+    template = bedfiles[0].replace(f'_{nums[0]}.bed', '_${num}.bed')
+    file = make_sh(bamfiles, template, shdir, pool, pooldir, program, mapfilter, get_array(nums, throttle))
+    arrayid = sbatch(file)
+    return arrayid, [f'{arrayid}_{int(num)}' for num in nums]
 
 
-def main(parentdir, pool):
+def create_combine(pids, parentdir, pool, program, shdir, cpus=8, groupsize=None, arrayid=None):
+    """Create command file to combine crisp or varscan jobs once they're finished.
+
+    Positional arguments:
+    pids = list of slurm job id dependencies (the jobs that need to finish first)
+    ...
+
+    Keyword arguments:
+    cpus = number of cpus to request, combine_crispORvarscan.py filters with one worker per cpu
+    groupsize = max number of bedfiles per group job (tree-reduction), None for one combine job
+    arrayid = slurm job id of the job array if pids are its tasks, one combine job then depends on the array
+    """
+    pooldir = op.join(parentdir, pool)
+    email_text = get_email_info(parentdir, 'final')
+    cmd = f'python $HOME/pipeline/combine_crispORvarscan.py {pooldir} {program} {pool}'
+    if groupsize is None or len(pids) <= groupsize:
+        write_combine(shdir, f'{pool}-combine-{program}', pids if arrayid is None else [arrayid], f'{cmd} {cpus}',
+                      cpus, '20000M', '12:00:00', email_text)
+        return
+
+    # tree-reduction: each group job combines its bedfiles as soon as they finish ...
+    ngroups = math.ceil(len(pids) / groupsize)
+    grouppids = []
+    for group, dependencies in enumerate(get_groups(pids, ngroups)):
+        grouppids.append(write_combine(shdir,
+                                       f'{pool}-combine-{program}_group_{group:04}',
+                                       dependencies,
+                                       f'{cmd} {cpus} {group} {ngroups}',
+                                       cpus, '20000M', '12:00:00'))
+    # ... and a small final job merges the sorted group files
+    write_combine(shdir, f'{pool}-combine-{program}', grouppids, f'{cmd} 1 final {ngroups}',
+                  1, '4000M', '3:00:00', email_text)
+
+
+def main(parentdir, pool, mapfilter=True, throttle=ARRAY_THROTTLE, samp=None):
     """Start <program> if it's appropriate to do so."""
 
+    # record that the IndelRealigner job for samp finished
+    if samp is not None:
+        record_done(op.join(parentdir, pool), samp)
+
     # check to see if all bam files have been created; if not: exit()
     bamfiles = checkfiles(op.join(parentdir, pool))
 
     # create reservation so other files don't try and write files.sh, exit() if needed
     shdir = create_reservation(op.join(parentdir, pool))
 
-    # create .sh files
-    #for program in ['crisp', 'varscan']:  # I'll be deprecating crisp soon
-    for program in ['varscan']:
-        print('starting %s commands' % program)
-        # create .sh file and submit to scheduler
+    # split the reference into bedfiles with about the same number of the pool's reads
+    # the pool is now reserved, so calling must still start (with the ref's bedfiles) if this fails
+    ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
+    try:
+        create_bedfiles.make_pool_bedfiles(ref, op.join(parentdir, pool), list(bamfiles.values()))
+    except Exception as e:
+        create_bedfiles.fall_back(ref, op.join(parentdir, pool), 'could not create bedfiles (%s)' % e)
+
+    # create .sh files, one job per bedfile slices the bams once for all PROGRAMS
+    caller = 'crispANDvarscan' if len(PROGRAMS) > 1 else PROGRAMS[0]
+    print('starting %s commands' % caller)
+    # create .sh file and submit to scheduler
+    if throttle > 0:
+        arrayid, pids = create_array(bamfiles.values(),
+                                     shdir,
+                                     pool,
+                                     op.join(parentdir, pool),
+                                     caller,
+                                     mapfilter,
+                                     throttle)
+    else:
+        arrayid = None
         pids = create_sh(bamfiles.values(),
                          shdir,
                          pool,
                          op.join(parentdir, pool),
-                         program)
+                         caller,
+                         mapfilter)
 
-        # create .sh file to combine crisp parallels using jobIDs as dependencies
-        create_combine(pids, parentdir, pool, program, shdir)
+    # create .sh files to combine crisp parallels using jobIDs as dependencies
+    for program in PROGRAMS:
+        create_combine(pids, parentdir, pool, program, shdir, groupsize=COMBINE_GROUPSIZE, arrayid=arrayid)
 
 
 if __name__ == "__main__":
     # args
-    thisfile, parentdir, pool = sys.argv
+    thisfile, parentdir, pool, *args = sys.argv
+    samp = args[0] if len(args) > 0 and args[0] != 'None' else None
+    mapfilter = False if len(args) > 1 and args[1] == 'False' else True
+    throttle = int(args[2]) if len(args) > 2 else ARRAY_THROTTLE
 
-    main(parentdir, pool)
+    main(parentdir, pool, mapfilter, throttle, samp)